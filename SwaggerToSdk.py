@@ -1,5 +1,6 @@
 """Swagger to SDK"""
 import platform
+import sys
 import shutil
 import os
 import stat
@@ -7,16 +8,23 @@ import subprocess
 import logging
 import tempfile
 import argparse
+import functools
 import json
 import zipfile
 import re
+import fnmatch
+import time
+import threading
+import hashlib
+import sqlite3
+import statistics
 from io import BytesIO
 from pathlib import Path
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
 
-import requests
-from git import Repo, GitCommandError
-from github import Github, GithubException
+# requests, GitPython and PyGithub are imported when needed only, to keep a fast startup
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -33,6 +41,44 @@ DEFAULT_COMMIT_MESSAGE = 'Generated from {hexsha}'
 
 IS_TRAVIS = os.environ.get('TRAVIS') == 'true'
 
+STARTUP_WORKERS = 6
+
+CACHE_DIR = os.environ.get('SWAGGER_TO_SDK_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.swagger_to_sdk'))
+
+SHARD_MANIFEST_FILE = 'manifest.json'
+SHARD_DURATIONS_FILE = 'durations.json'
+
+DEFAULT_JOBS = 1
+DEFAULT_MEMORY_RESERVE = 512 * 1024 * 1024
+DEFAULT_AUTOREST_MEMORY = 1024 * 1024 * 1024
+SCHEDULER_POLL_INTERVAL = 0.5
+
+DEFAULT_ARTIFACT_STORE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+# os.umask can only be read by setting it, done once at import before any thread starts
+UMASK = os.umask(0)
+os.umask(UMASK)
+ARTIFACT_STORE_TIMEOUT = 60
+
+JOURNAL_FILE = 'journal.json'
+JOURNAL_GENERATED_DIR = 'generated'
+
+HISTORY_LAST_RUNS = 5
+DEFAULT_REGRESSION_THRESHOLD = 0.5
+HISTORY_SCHEMA = """CREATE TABLE IF NOT EXISTS project_timing (
+    run_started REAL NOT NULL,
+    project TEXT NOT NULL,
+    autorest_version TEXT,
+    spec_hash TEXT,
+    generate_duration REAL,
+    update_duration REAL,
+    output_size INTEGER,
+    output_changed INTEGER,
+    peak_rss INTEGER,
+    autorest_hash TEXT
+)"""
+HISTORY_ADDED_COLUMNS = [('peak_rss', 'INTEGER'), ('autorest_hash', 'TEXT')]
+
 def get_documents_in_composite_file(composite_filepath):
     """Get the documents inside this composite file, relative to the repo root.
 
@@ -78,9 +124,83 @@ def read_config(sdk_git_folder, config_file):
     with open(config_path, 'r') as config_fd:
         return json.loads(config_fd.read())
 
+def read_config_from_github(gh_token, sdk_git_id, config_file, branch_names):
+    """Read the configuration file using the Github API, from the first existing branch.
+    The GH token is optional if the repo is public."""
+    from github import Github, GithubException
+
+    github_repo = Github(gh_token).get_repo(sdk_git_id)
+    for branch_name in branch_names:
+        if not branch_name:
+            continue
+        try:
+            config_content = github_repo.get_contents(config_file, ref=branch_name)
+        except GithubException as err:
+            if err.status == 404:
+                continue
+            raise
+        return json.loads(config_content.decoded_content.decode('utf-8'))
+    raise ValueError('{} not found in {} on branches {}'.format(config_file, sdk_git_id, branch_names))
+
+def read_config_from_tree(tree, config_file):
+    """Read the configuration file from a git tree and return JSON"""
+    return json.loads((tree / config_file).data_stream.read().decode('utf-8'))
+
+def validate_config(config):
+    """Check the configuration content.
+
+    :returns: The list of errors, empty if the configuration is valid
+    :rtype: list<str>"""
+    if not isinstance(config, dict):
+        return ['Configuration must be a JSON object']
+    errors = []
+
+    global_conf = config.get('meta')
+    if not isinstance(global_conf, dict):
+        errors.append('"meta" must be an object')
+        global_conf = {}
+    elif not isinstance(global_conf.get('language'), str):
+        errors.append('"meta" must define "language"')
+
+    projects = config.get('projects')
+    if not isinstance(projects, dict):
+        errors.append('"projects" must be an object')
+        projects = {}
+
+    confs = [('meta', global_conf)] + [('project "{}"'.format(project), local_conf)
+                                       for project, local_conf in sorted(projects.items())]
+    for name, conf in confs:
+        if not isinstance(conf, dict):
+            errors.append('{} must be an object'.format(name))
+            continue
+        if name != 'meta':
+            for key in ('swagger', 'output_dir'):
+                if not isinstance(conf.get(key), str):
+                    errors.append('{} must define "{}"'.format(name, key))
+        for key, expected_type, type_name in [
+                ('autorest_options', dict, 'an object'),
+                ('wrapper_filesOrDirs', list, 'a list'),
+                ('delete_filesOrDirs', list, 'a list'),
+                ('normalize_lines', list, 'a list'),
+                ('generated_relative_base_directory', str, 'a string')]:
+            if key in conf and not isinstance(conf[key], expected_type):
+                errors.append('{} "{}" must be {}'.format(name, key, type_name))
+        if isinstance(conf.get('normalize_lines'), list):
+            for rule in conf['normalize_lines']:
+                if not isinstance(rule, str):
+                    errors.append('{} "normalize_lines" must be a list of strings'.format(name))
+                    continue
+                try:
+                    re.compile(rule.encode('utf-8'))
+                except re.error as err:
+                    errors.append('{} "normalize_lines" has an invalid regexp {!r}: {}'.format(name, rule, err))
+    return errors
+
 
 def download_install_autorest(output_dir, autorest_version=LATEST_TAG):
     """Download and install Autorest in the given folder"""
+    import requests
+
     download_link = AUTOREST_BASE_DOWNLOAD_LINK
     if autorest_version != LATEST_TAG:
         download_link += autorest_version
@@ -129,8 +249,10 @@ def build_autorest_options(language, global_conf, local_conf):
     sorted_keys = sorted(list(merged_options.keys())) # To be honest, just to help for tests...
     return " ".join("-{} {}".format(key, str(merged_options[key])) for key in sorted_keys)
 
-def generate_code(language, swagger_file, output_dir, autorest_exe_path, global_conf=None, local_conf=None):
-    """Call the Autorest process with the given parameters"""
+def generate_code(language, swagger_file, output_dir, autorest_exe_path, global_conf=None, local_conf=None,
+                  process_callback=None):
+    """Call the Autorest process with the given parameters.
+    If provided, process_callback is called with the subprocess.Popen of Autorest."""
     if NEEDS_MONO:
         autorest_exe_path = 'mono ' + autorest_exe_path
 
@@ -144,9 +266,15 @@ def generate_code(language, swagger_file, output_dir, autorest_exe_path, global_
     _LOGGER.info("Autorest cmd line:\n%s", cmd_line)
 
     try:
-        result = subprocess.check_output(cmd_line.split(),
-                                         stderr=subprocess.STDOUT,
-                                         universal_newlines=True)
+        process = subprocess.Popen(cmd_line.split(),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+        if process_callback:
+            process_callback(process)
+        result = process.communicate()[0]
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd_line, output=result)
     except subprocess.CalledProcessError as err:
         _LOGGER.error(err)
         _LOGGER.error(err.output)
@@ -160,6 +288,8 @@ def generate_code(language, swagger_file, output_dir, autorest_exe_path, global_
 
 def get_swagger_hexsha(restapi_git_folder):
     """Get the SHA1 of the current repo"""
+    from git import Repo
+
     repo = Repo(restapi_git_folder)
     if repo.bare:
         not_git_hexsha = "notgitrepo"
@@ -170,16 +300,72 @@ def get_swagger_hexsha(restapi_git_folder):
     return hexsha
 
 
-def update(generated_folder, destination_folder, global_conf, local_conf):
-    """Update data from generated to final folder"""
-    wrapper_files_or_dirs = merge_options(global_conf, local_conf, "wrapper_filesOrDirs") or []
-    delete_files_or_dirs = merge_options(global_conf, local_conf, "delete_filesOrDirs") or []
+def get_client_generated_path(generated_folder, global_conf, local_conf):
+    """Get the folder of generated data to consider, using generated_relative_base_directory.
+    :rtype: pathlib.Path"""
     generated_relative_base_directory = local_conf.get('generated_relative_base_directory') or \
         global_conf.get('generated_relative_base_directory')
 
     client_generated_path = Path(generated_folder)
     if generated_relative_base_directory:
         client_generated_path = next(client_generated_path.glob(generated_relative_base_directory))
+    return client_generated_path
+
+
+def is_normalized_diff(generated_content, dest_content, rules):
+    """Check if both contents differ only on lines matched by one of the rules.
+
+    :param list rules: Compiled bytes regexp
+    """
+    generated_lines = generated_content.splitlines(True)
+    dest_lines = dest_content.splitlines(True)
+    if len(generated_lines) != len(dest_lines):
+        return False
+    return all(
+        generated_line == dest_line or (
+            any(rule.search(generated_line) for rule in rules) and
+            any(rule.search(dest_line) for rule in rules)
+        )
+        for generated_line, dest_line in zip(generated_lines, dest_lines)
+    )
+
+
+def normalize_generated(generated_folder, read_dest_file, global_conf, local_conf):
+    """Restore the destination content of generated files differing only on volatile lines.
+    Volatile lines are matched by the regexp in "normalize_lines".
+
+    :param callable read_dest_file: Return the destination content of a relative POSIX path,
+     None if there is no such file.
+    :returns: The number of restored files
+    :rtype: int"""
+    rules = merge_options(global_conf, local_conf, "normalize_lines")
+    if not rules:
+        return 0
+    rules = [re.compile(rule.encode('utf-8')) for rule in rules]
+
+    client_generated_path = get_client_generated_path(generated_folder, global_conf, local_conf)
+    restored = 0
+    for file_path in client_generated_path.glob('**/*'):
+        if not file_path.is_file():
+            continue
+        dest_content = read_dest_file(file_path.relative_to(client_generated_path).as_posix())
+        if dest_content is None:
+            continue
+        generated_content = file_path.read_bytes()
+        if generated_content != dest_content and \
+                is_normalized_diff(generated_content, dest_content, rules):
+            file_path.write_bytes(dest_content)
+            restored += 1
+    if restored:
+        _LOGGER.info("%s generated files differ only on normalized lines, kept unchanged", restored)
+    return restored
+
+
+def update(generated_folder, destination_folder, global_conf, local_conf):
+    """Update data from generated to final folder"""
+    wrapper_files_or_dirs = merge_options(global_conf, local_conf, "wrapper_filesOrDirs") or []
+    delete_files_or_dirs = merge_options(global_conf, local_conf, "delete_filesOrDirs") or []
+    client_generated_path = get_client_generated_path(generated_folder, global_conf, local_conf)
 
     for wrapper_file_or_dir in wrapper_files_or_dirs:
         for file_path in Path(destination_folder).glob(wrapper_file_or_dir):
@@ -197,6 +383,94 @@ def update(generated_folder, destination_folder, global_conf, local_conf):
     shutil.rmtree(destination_folder)
     client_generated_path.replace(destination_folder)
 
+def match_wrapper_pattern(relative_path, pattern):
+    """Match a POSIX relative path with a glob pattern, the path being the match or inside it.
+    Same semantic as Path.glob, without '**' support.
+    :returns: The matched path, the path itself or its matched parent folder. None if no match."""
+    path_parts = relative_path.split('/')
+    pattern_parts = pattern.split('/')
+    if len(path_parts) < len(pattern_parts):
+        return None
+    if not all(fnmatch.fnmatchcase(path_part, pattern_part)
+               for path_part, pattern_part in zip(path_parts, pattern_parts)):
+        return None
+    return '/'.join(path_parts[:len(pattern_parts)])
+
+def store_blob(repo, data):
+    """Store data as a blob in the object database, if not already there.
+    :returns: The binary SHA1 of the blob"""
+    from gitdb import IStream
+
+    binsha = hashlib.sha1(b'blob ' + str(len(data)).encode() + b'\0' + data).digest()
+    if not repo.odb.has_object(binsha):
+        repo.odb.store(IStream('blob', len(data), BytesIO(data)))
+    return binsha
+
+def get_output_dir_prefix(output_dir):
+    """The prefix of the index entries inside this output_dir"""
+    return Path(output_dir).as_posix().strip('/') + '/'
+
+def update_index(generated_folder, sdk_index, output_dir, global_conf, local_conf):
+    """Same as update, but in an in-memory index instead of the working tree.
+    Generated files are stored as blobs in the object database."""
+    from git.index import BaseIndexEntry, IndexEntry
+
+    wrapper_files_or_dirs = merge_options(global_conf, local_conf, "wrapper_filesOrDirs") or []
+    delete_files_or_dirs = merge_options(global_conf, local_conf, "delete_filesOrDirs") or []
+    unsupported_wrappers = [pattern for pattern in wrapper_files_or_dirs if '**' in pattern]
+    if unsupported_wrappers:
+        err_msg = '"**" is not supported in wrapper_filesOrDirs with --object-db: {}'.format(
+            ", ".join(unsupported_wrappers))
+        _LOGGER.critical(err_msg)
+        raise ValueError(err_msg)
+    client_generated_path = get_client_generated_path(generated_folder, global_conf, local_conf)
+
+    for delete_file_or_dir in delete_files_or_dirs:
+        for file_path in client_generated_path.glob(delete_file_or_dir):
+            if file_path.is_file():
+                file_path.unlink()
+            else:
+                shutil.rmtree(str(file_path))
+
+    prefix = get_output_dir_prefix(output_dir)
+    # Files or folders of the destination replacing the generated ones
+    kept_wrappers = set()
+    for path, stage in list(sdk_index.entries):
+        if not path.startswith(prefix):
+            continue
+        wrappers = {match_wrapper_pattern(path[len(prefix):], pattern)
+                    for pattern in wrapper_files_or_dirs} - {None}
+        if wrappers:
+            kept_wrappers |= wrappers
+        else:
+            del sdk_index.entries[(path, stage)]
+
+    for file_path in client_generated_path.glob('**/*'):
+        if not file_path.is_file():
+            continue
+        relative_file_path = file_path.relative_to(client_generated_path).as_posix()
+        if any(relative_file_path == wrapper or relative_file_path.startswith(wrapper + '/')
+               for wrapper in kept_wrappers):
+            continue
+        mode = 0o100755 if os.access(str(file_path), os.X_OK) else 0o100644
+        binsha = store_blob(sdk_index.repo, file_path.read_bytes())
+        entry_path = prefix + relative_file_path
+        sdk_index.entries[(entry_path, 0)] = IndexEntry.from_base(
+            BaseIndexEntry((mode, binsha, 0, entry_path)))
+
+    shutil.rmtree(generated_folder)
+
+def get_index_output_stats(sdk_index, base_tree, output_dir):
+    """Size of the output_dir in the index, and if it changed from the base tree.
+    :rtype: tuple<int, bool>"""
+    prefix = get_output_dir_prefix(output_dir)
+    output_entries = {(path, entry.binsha) for (path, _), entry in sdk_index.entries.items()
+                      if path.startswith(prefix)}
+    base_entries = {(blob.path, blob.binsha) for blob in (base_tree / prefix.rstrip('/')).traverse()
+                    if blob.type == 'blob'}
+    output_size = sum(sdk_index.repo.odb.info(binsha).size for _, binsha in output_entries)
+    return output_size, output_entries != base_entries
+
 def checkout_and_create_branch(repo, name):
     """Checkout branch. Create it if necessary"""
     local_branch = repo.branches[name] if name in repo.branches else None
@@ -240,8 +514,36 @@ def do_commit(repo, message_template, branch_name, hexsha):
     return True
 
 
+def get_base_commit(repo, branch_name, base_branch_name):
+    """Commit of the destination branch if it already exists, of the base branch otherwise.
+    Expects a bare clone, where every remote branch is a local head."""
+    if branch_name and branch_name in repo.heads:
+        _LOGGER.info('Destination branch %s already exists', branch_name)
+        return repo.heads[branch_name].commit
+    _LOGGER.info('Destination branch does not exists')
+    return repo.heads[base_branch_name].commit
+
+
+def do_commit_from_index(repo, sdk_index, base_commit, message_template, branch_name, hexsha):
+    "Do a commit of the index tree if different from the base commit, without checkout"
+    from git.objects import Commit
+
+    tree = sdk_index.write_tree()
+    if tree.binsha == base_commit.tree.binsha:
+        _LOGGER.warning('No modified files in this Autorest run')
+        return False
+
+    msg = message_template.format(hexsha=hexsha)
+    commit = Commit.create_from_tree(repo, tree, msg, parent_commits=[base_commit])
+    repo.create_head(branch_name, commit, force=True)
+    _LOGGER.info("Commit done: %s", msg)
+    return True
+
+
 def do_pr(gh_token, sdk_git_id, sdk_pr_target_repo_id, branch_name, base_branch):
     "Do the PR"
+    from github import Github, GithubException
+
     if not gh_token:
         _LOGGER.info('Skipping the PR, no token found')
         return
@@ -285,6 +587,8 @@ def get_pr_object_from_travis(gh_token=None):
        If result is None, is not Travis.
        The GH token is optional if the repo is public.
     """
+    from github import Github
+
     if not IS_TRAVIS:
         return
     pr_number = os.environ['TRAVIS_PULL_REQUEST']
@@ -304,42 +608,107 @@ def compute_pr_comment_with_sdk_pr(comment, sdk_fork_id, branch_name):
                                          fork_repo_id=sdk_fork_id)
     return travis_string+' '+comment
 
+def get_initial_pr_cache_path(repo_slug, commit_sha):
+    """Path of the cached initial PR of this commit.
+    :rtype: pathlib.Path"""
+    return Path(CACHE_DIR, 'initial_pr', repo_slug.replace('/', '_'), commit_sha + '.json')
+
+def find_merged_pr(github_repo, pr_numbers):
+    """Return the first merged PR in this list of numbers, None if there is none.
+    PRs are fetched concurrently. Github errors other than "Not Found" are raised."""
+    from github import GithubException
+
+    pr_numbers = list(OrderedDict.fromkeys(int(pr_number) for pr_number in pr_numbers))
+    if not pr_numbers:
+        return None
+
+    def get_pull(pr_number):
+        """Get the PR object, None if this is not a PR"""
+        try:
+            _LOGGER.info('Check if %s is a PR', pr_number)
+            return github_repo.get_pull(pr_number)
+        except GithubException as err:
+            if err.status != 404:
+                raise
+            _LOGGER.info('%s is not a PR', pr_number)
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(len(pr_numbers), STARTUP_WORKERS)) as executor:
+        pulls = list(executor.map(get_pull, pr_numbers))
+    return next((pull for pull in pulls if pull and pull.merged), None)
+
 def get_pr_from_travis_commit_sha(gh_token=None):
     """Try to determine the initial PR using #<number> in the current commit comment.
     Will check if the found number is really a merged PR.
+    The result is cached on disk per commit SHA, see CACHE_DIR.
     The GH token is optional if the repo is public."""
+    from github import Github, GithubException
+    from github.PullRequest import PullRequest
+
     if not IS_TRAVIS:
         return
+    repo_slug, commit_sha = os.environ['TRAVIS_REPO_SLUG'], os.environ['TRAVIS_COMMIT']
     github_con = Github(gh_token)
-    github_repo = github_con.get_repo(os.environ['TRAVIS_REPO_SLUG'])
 
-    local_commit = github_repo.get_commit(os.environ['TRAVIS_COMMIT'])
+    cache_path = get_initial_pr_cache_path(repo_slug, commit_sha)
+    if cache_path.exists():
+        try:
+            with cache_path.open() as cache_fd:
+                pr_raw_data = json.load(cache_fd)['pr']
+        except (OSError, ValueError, KeyError) as err:
+            _LOGGER.warning('Ignore unreadable initial PR cache %s: %s', cache_path, err)
+        else:
+            _LOGGER.info('Initial PR read from cache %s', cache_path)
+            return github_con.create_from_raw_data(PullRequest, pr_raw_data) if pr_raw_data else None
+
+    github_repo = github_con.get_repo(repo_slug)
+
+    local_commit = github_repo.get_commit(commit_sha)
     commit_message = local_commit.commit.message
     issues_in_message = re.findall('#([\\d]+)', commit_message)
 
-    issue_object = None
-    for issue in issues_in_message:
-        try:
-            _LOGGER.info('Check if %s is a PR', issue)
-            issue_object = github_repo.get_pull(int(issue))
-            if not issue_object.is_merged():
-                continue
-            break
-        except Exception as err:
-            pass
+    try:
+        issue_object = find_merged_pr(github_repo, issues_in_message)
+    except GithubException as err:
+        # Not cached, the next run will try again
+        _LOGGER.warning('Was not able to check the PR of the commit message: %s', err)
+        return None
     if not issue_object:
         _LOGGER.warning('Was not able to found PR commit message')
+
+    # Written atomically, a concurrent run never reads a partial cache
+    try:
+        if not cache_path.parent.exists():
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=str(cache_path.parent), suffix='.tmp',
+                                         delete=False) as cache_fd:
+            json.dump({'pr': issue_object.raw_data if issue_object else None}, cache_fd)
+        os.replace(cache_fd.name, str(cache_path))
+    except OSError as err:
+        _LOGGER.warning('Unable to write initial PR cache %s: %s', cache_path, err)
     return issue_object
 
 def get_initial_pr(gh_token=None):
     """Try to deduce the initial PR of the current repo state.
     Use Travis env variable first, try with commit regexp otherwise.
     gh_token could be None for public repo.
+    The result is computed once per run for the same Travis environment.
 
     :param str gh_token: A Github token. Useful only if the repo is private.
     :return: A PR object if found, None otherwise
     :rtype: github.PullRequest.PullRequest
     """
+    travis_env = tuple(os.environ.get(key)
+                       for key in ('TRAVIS_REPO_SLUG', 'TRAVIS_PULL_REQUEST', 'TRAVIS_COMMIT'))
+    # lru_cache does not wait for a call in progress, concurrent callers would both resolve it
+    with _INITIAL_PR_LOCK:
+        return find_initial_pr(gh_token, travis_env)
+
+_INITIAL_PR_LOCK = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def find_initial_pr(gh_token, travis_env):
+    """Cached implementation of get_initial_pr. travis_env is only used as cache key."""
     return get_pr_object_from_travis(gh_token) or \
         get_pr_from_travis_commit_sha(gh_token)
 
@@ -362,13 +731,18 @@ def configure_user(gh_token, repo):
     repo.git.config('user.email', user.email or 'autorestci@microsoft.com')
     repo.git.config('user.name', user.name or 'SwaggerToSDK Automation')
 
+@functools.lru_cache(maxsize=None)
 def user_from_token(gh_token):
     """Get user login from GitHub token"""
+    from github import Github
+
     github_con = Github(gh_token)
     return github_con.get_user()
 
 def sync_fork(gh_token, github_repo_id, repo):
     """Sync the current branch in this fork against the direct parent on Github"""
+    from github import Github
+
     if not gh_token:
         _LOGGER.warning('Skipping the upstream repo sync, no token')
         return
@@ -398,8 +772,10 @@ def get_full_sdk_id(gh_token, sdk_git_id):
         return '{}/{}'.format(login, sdk_git_id)
     return sdk_git_id
 
-def clone_to_path(gh_token, temp_dir, sdk_git_id):
+def clone_to_path(gh_token, temp_dir, sdk_git_id, bare=False):
     """Clone the given repo_id to the 'sdk' folder in given temp_dir"""
+    from git import Repo
+
     _LOGGER.info("Clone SDK repository %s", sdk_git_id)
 
     credentials_part = ''
@@ -417,7 +793,7 @@ def clone_to_path(gh_token, temp_dir, sdk_git_id):
         sdk_git_id=sdk_git_id
     )
     sdk_path = os.path.join(temp_dir, 'sdk')
-    Repo.clone_from(https_authenticated_url, sdk_path)
+    Repo.clone_from(https_authenticated_url, sdk_path, bare=bare)
     _LOGGER.info("Clone success")
 
     return sdk_path
@@ -428,16 +804,23 @@ def remove_readonly(func, path, _):
     func(path)
 
 @contextmanager
-def manage_sdk_folder(gh_token, temp_dir, sdk_git_id):
+def clean_sdk_folder(sdk_path):
     """Context manager to avoid readonly problem while cleanup the temp dir"""
-    sdk_path = clone_to_path(gh_token, temp_dir, sdk_git_id)
-    _LOGGER.debug("SDK path %s", sdk_path)
     try:
         yield sdk_path
         # Pre-cleanup for Windows http://bugs.python.org/issue26660
     finally:
-        _LOGGER.debug("Preclean SDK folder")
-        shutil.rmtree(sdk_path, onerror=remove_readonly)
+        if os.path.exists(sdk_path):
+            _LOGGER.debug("Preclean SDK folder")
+            shutil.rmtree(sdk_path, onerror=remove_readonly)
+
+@contextmanager
+def manage_sdk_folder(gh_token, temp_dir, sdk_git_id, bare=False):
+    """Context manager to avoid readonly problem while cleanup the temp dir"""
+    sdk_path = clone_to_path(gh_token, temp_dir, sdk_git_id, bare)
+    _LOGGER.debug("SDK path %s", sdk_path)
+    with clean_sdk_folder(sdk_path):
+        yield sdk_path
 
 def install_autorest(temp_dir, global_conf=None, autorest_dir=None):
     """ Return an AutoRest.exe path.
@@ -460,76 +843,930 @@ def install_autorest(temp_dir, global_conf=None, autorest_dir=None):
     return download_install_autorest(autorest_temp_dir, autorest_version)
 
 
-def build_libraries(gh_token, config_path, project_pattern, restapi_git_folder,
-         sdk_git_id, pr_repo_id, message_template, base_branch_name, branch_name,
-         autorest_dir=None):
-    """Main method of the the file"""
-    sdk_git_id = get_full_sdk_id(gh_token, sdk_git_id)
+def install_autorest_from_github_config(temp_dir, gh_token, sdk_git_id, config_file,
+                                       branch_names, autorest_dir=None):
+    """Install AutoRest using the configuration read with the Github API, to not wait for the clone.
 
-    with tempfile.TemporaryDirectory() as temp_dir, \
-            manage_sdk_folder(gh_token, temp_dir, sdk_git_id) as sdk_folder:
+    :returns: The AutoRest.exe path, and the version installed
+    :rtype: tuple<str, str>"""
+    if autorest_dir:
+        return install_autorest(temp_dir, autorest_dir=autorest_dir), None
+    global_conf = read_config_from_github(gh_token, sdk_git_id, config_file, branch_names)["meta"]
+    return install_autorest(temp_dir, global_conf), global_conf.get("autorest", LATEST_TAG)
 
-        sdk_repo = Repo(sdk_folder)
-        if gh_token:
-            branch_name = compute_branch_name(branch_name, gh_token)
-            _LOGGER.info('Destination branch for generated code is %s', branch_name)
-            configure_user(gh_token, sdk_repo)
-            try:
-                _LOGGER.info('Try to checkout the destination branch if it already exists')
-                sdk_repo.git.checkout(branch_name)
-            except GitCommandError:
-                _LOGGER.info('Destination branch does not exists')
-                sdk_repo.git.checkout(base_branch_name)
-            sync_fork(gh_token, sdk_git_id, sdk_repo)
-        else:
-            _LOGGER.info('No token provided, simply checkout base branch')
-            sdk_repo.git.checkout(base_branch_name)
+def check_installed_autorest(autorest_future, temp_dir, global_conf, autorest_dir=None):
+    """Return the AutoRest.exe path installed by the future if it matches the configuration.
+    Install it again otherwise."""
+    try:
+        autorest_exe_path, autorest_version = autorest_future.result()
+    except Exception as err:
+        _LOGGER.warning("AutoRest install during startup failed, try again: %s", err)
+    else:
+        if autorest_dir or autorest_version == global_conf.get("autorest", LATEST_TAG):
+            return autorest_exe_path
+        _LOGGER.warning("AutoRest %s installed during startup, but configuration asks for %s",
+                        autorest_version, global_conf.get("autorest", LATEST_TAG))
+    return install_autorest(tempfile.mkdtemp(dir=temp_dir), global_conf, autorest_dir)
+
+def get_swagger_references(swagger_path):
+    """Files referenced by a "$ref" of this Swagger file, remote references excluded.
+    :rtype: list<pathlib.Path>"""
+    try:
+        with swagger_path.open(encoding='utf-8') as swagger_fd:
+            nodes = [json.load(swagger_fd)]
+    except ValueError:
+        return []
+    references = set()
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, dict):
+            reference = node.get('$ref')
+            if isinstance(reference, str):
+                reference_file = reference.split('#')[0]
+                if reference_file and not re.match(r'\w+://', reference_file):
+                    references.add(reference_file)
+            nodes.extend(node.values())
+        elif isinstance(node, list):
+            nodes.extend(node)
+    return [Path(os.path.normpath(str(swagger_path.parent.joinpath(reference))))
+            for reference in sorted(references)]
+
+def compute_spec_hash(restapi_git_folder, swagger):
+    """SHA1 of the Swagger file. For a composite file, documents are hashed too.
+    Files referenced through "$ref" (shared definitions) are hashed too, recursively."""
+    swagger_path = Path(restapi_git_folder, swagger)
+    spec_hash = hashlib.sha1(swagger_path.read_bytes())
+    if swagger_path.name.startswith('composite'):
+        documents = [Path(os.path.normpath(str(Path(restapi_git_folder, document))))
+                     for document in get_documents_in_composite_file(swagger_path)]
+    else:
+        documents = get_swagger_references(swagger_path)
+    hashed = {os.path.normpath(str(swagger_path))}
+    while documents:
+        document_path = documents.pop(0)
+        if str(document_path) in hashed or not document_path.is_file():
+            continue
+        hashed.add(str(document_path))
+        spec_hash.update(document_path.read_bytes())
+        documents.extend(get_swagger_references(document_path))
+    return spec_hash.hexdigest()
+
+def get_folder_size(folder):
+    """Total size in bytes of the files in this folder"""
+    return sum(path.stat().st_size for path in Path(folder).glob('**/*') if path.is_file())
+
+def open_history(history_db):
+    """Open the SQLite timing history, creating it if necessary"""
+    connection = sqlite3.connect(history_db)
+    connection.execute(HISTORY_SCHEMA)
+    columns = [column[1] for column in connection.execute("PRAGMA table_info(project_timing)")]
+    for column, column_type in HISTORY_ADDED_COLUMNS:
+        if column not in columns:
+            # History created before this column was recorded
+            connection.execute("ALTER TABLE project_timing ADD COLUMN {} {}".format(column, column_type))
+    return connection
+
+def record_project_timing(history_db, run_started, project, timing):
+    """Save the timing of one project in the history.
+
+    :param dict timing: autorest_version, spec_hash, generate_duration, update_duration,
+     output_size, output_changed and optionally peak_rss and autorest_hash
+    """
+    with closing(open_history(history_db)) as connection, connection:
+        connection.execute(
+            "INSERT INTO project_timing (run_started, project, autorest_version, spec_hash, "
+            "generate_duration, update_duration, output_size, output_changed, peak_rss, autorest_hash) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (run_started, project,
+             timing['autorest_version'], timing['spec_hash'],
+             timing['generate_duration'], timing['update_duration'],
+             timing['output_size'], int(timing['output_changed']),
+             timing.get('peak_rss'), timing.get('autorest_hash'))
+        )
 
-        config = read_config(sdk_repo.working_tree_dir, config_path)
+def load_history(history_db):
+    """Load the history, grouped by project, most recent run first.
+    :rtype: dict"""
+    with closing(open_history(history_db)) as connection:
+        connection.row_factory = sqlite3.Row
+        rows = connection.execute(
+            "SELECT * FROM project_timing ORDER BY project, run_started DESC"
+        ).fetchall()
+    history = {}
+    for row in rows:
+        history.setdefault(row['project'], []).append(dict(row))
+    return history
+
+def load_history_peak_rss(history_db, last_runs=HISTORY_LAST_RUNS):
+    """Max peak RSS in bytes of the Autorest process in the last runs, per project.
+    :rtype: dict"""
+    peak_rss = {}
+    for project, runs in load_history(history_db).items():
+        project_peak_rss = [run['peak_rss'] for run in runs[:last_runs] if run['peak_rss']]
+        if project_peak_rss:
+            peak_rss[project] = max(project_peak_rss)
+    return peak_rss
+
+def is_autorest_changed(run, previous_run):
+    """Compare the AutoRest binary hash if both runs recorded it, the version otherwise.
+    "latest" may be a new binary with the same version."""
+    if run['autorest_hash'] and previous_run['autorest_hash']:
+        return run['autorest_hash'] != previous_run['autorest_hash']
+    return run['autorest_version'] != previous_run['autorest_version']
+
+def find_regressions(history_db, threshold=DEFAULT_REGRESSION_THRESHOLD, last_runs=HISTORY_LAST_RUNS):
+    """Find the projects whose last generation time is more than (1+threshold) times
+    the median of the previous runs.
+    :rtype: list<dict>"""
+    regressions = []
+    for project, runs in sorted(load_history(history_db).items()):
+        if len(runs) < 2:
+            continue
+        latest, previous_runs = runs[0], runs[1:last_runs+1]
+        baseline = statistics.median(run['generate_duration'] for run in previous_runs)
+        if latest['generate_duration'] > baseline * (1 + threshold):
+            regressions.append({
+                'project': project,
+                'duration': latest['generate_duration'],
+                'baseline': baseline,
+                'spec_changed': latest['spec_hash'] != previous_runs[0]['spec_hash'],
+                'autorest_changed': is_autorest_changed(latest, previous_runs[0])
+            })
+    return regressions
+
+def print_history_report(history_db, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """Print the generation time regressions found in the history.
+    :returns: True if at least one regression was found"""
+    regressions = find_regressions(history_db, threshold)
+    if not regressions:
+        print("No generation time regression over {:.0%}".format(threshold))
+        return False
+    print("Generation time regressions over {:.0%}:".format(threshold))
+    for regression in regressions:
+        reasons = [reason for reason, changed in [
+            ('spec changed', regression['spec_changed']),
+            ('AutoRest changed', regression['autorest_changed'])
+        ] if changed]
+        print("  {project}: {duration:.1f}s (median {baseline:.1f}s){reasons}".format(
+            reasons=' - '+', '.join(reasons) if reasons else '',
+            **regression
+        ))
+    return True
 
-        global_conf = config["meta"]
-        language = global_conf["language"]
-        hexsha = get_swagger_hexsha(restapi_git_folder)
+def get_available_memory():
+    """Available system memory in bytes, None if unknown (only Linux is supported)"""
+    try:
+        with open('/proc/meminfo') as meminfo_fd:
+            for line in meminfo_fd:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def get_process_memory(pid):
+    """Current and peak RSS in bytes of this process, (0, 0) if unknown (only Linux is supported)
+
+    :rtype: tuple<int, int>"""
+    memory = {}
+    try:
+        with open('/proc/{}/status'.format(pid)) as status_fd:
+            for line in status_fd:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    memory[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return memory.get('VmRSS', 0), memory.get('VmHWM', 0)
+
+def predict_autorest_memory(projects, peak_rss):
+    """Predict the Autorest memory in bytes of each project.
+    Peak RSS of past runs if known, the biggest known peak RSS otherwise.
+    :rtype: dict"""
+    default_memory = max(peak_rss.values()) if peak_rss else DEFAULT_AUTOREST_MEMORY
+    return {project: peak_rss.get(project, default_memory) for project in projects}
 
-        initial_pr = get_initial_pr(gh_token)
-        swagger_files_in_pr = get_swagger_project_files_in_pr(initial_pr) if initial_pr else set()
+def schedule_generations(generations, max_jobs=DEFAULT_JOBS, memory_reserve=DEFAULT_MEMORY_RESERVE):
+    """Run the generations concurrently, with memory admission control.
 
-        autorest_exe_path = install_autorest(temp_dir, global_conf, autorest_dir)
+    A generation is started only if the available memory, minus the predicted memory
+    not yet used by the running generations and by the new one, is over memory_reserve.
+    One generation is always allowed to run. After a failure, no new generation is started
+    and the first error is raised once the running ones are finished.
 
-        for project, local_conf in config["projects"].items():
-            if project_pattern and not any(project.startswith(p) for p in project_pattern):
-                _LOGGER.info("Skip project %s", project)
-                continue
+    :param list generations: (key, predicted_memory, function) tuples, in start order. The function
+     is called with a callback which must receive every subprocess.Popen started.
+    :returns: An iterator of (key, function result, peak RSS in bytes), in completion order.
+    """
+    pending = list(generations)
+    running = {}
+    errors = []
+    peak_memory = 0
+    start_time = time.time()
+    finished = 0
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        while running or (pending and not errors):
+            used_memory = 0
+            predicted_growth = 0
+            for job in running.values():
+                job_memory = 0
+                for process in job['processes']:
+                    rss, hwm = get_process_memory(process.pid)
+                    job_memory += rss
+                    job['peak_rss'] = max(job['peak_rss'], hwm, rss)
+                used_memory += job_memory
+                predicted_growth += max(job['predicted_memory'] - job_memory, 0)
+            peak_memory = max(peak_memory, used_memory)
+
+            available_memory = get_available_memory()
+            while pending and not errors and len(running) < max_jobs:
+                key, predicted_memory, function = pending[0]
+                if running and available_memory is not None and \
+                        available_memory - predicted_growth - predicted_memory < memory_reserve:
+                    _LOGGER.debug("Not enough memory to start %s, wait", key)
+                    break
+                pending.pop(0)
+                job = {'key': key, 'predicted_memory': predicted_memory, 'processes': [], 'peak_rss': 0}
+                running[executor.submit(function, job['processes'].append)] = job
+                predicted_growth += predicted_memory
+
+            done, _ = wait(running, timeout=SCHEDULER_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as err:
+                    _LOGGER.error("Generation of %s failed: %s", job['key'], err)
+                    errors.append(err)
+                    continue
+                finished += 1
+                yield job['key'], result, job['peak_rss'] or None
+
+    duration = time.time() - start_time
+    _LOGGER.info("Generated %s projects in %.1fs (%.1f projects/min), peak Autorest memory %.0f MB",
+                 finished, duration, finished * 60 / duration if duration else 0,
+                 peak_memory / (1024 * 1024))
+    if errors:
+        raise errors[0]
+
+def compute_file_hash(file_path):
+    """SHA1 of the file content"""
+    return hashlib.sha1(Path(file_path).read_bytes()).hexdigest()
+
+def compute_generation_hash(language, restapi_git_folder, global_conf, local_conf, autorest_hash):
+    """SHA1 of the inputs of the AutoRest generation of a project.
+    autorest_hash identifies the AutoRest binary, since "latest" is not a version."""
+    generation_inputs = [
+        language,
+        compute_spec_hash(restapi_git_folder, local_conf['swagger']),
+        autorest_hash,
+        build_autorest_options(language, global_conf, local_conf)
+    ]
+    return hashlib.sha1(json.dumps(generation_inputs).encode('utf-8')).hexdigest()
+
+def pack_generated(generated_path):
+    """Zip the generated folder, keeping the file modes.
+    :rtype: bytes"""
+    zip_content = BytesIO()
+    with zipfile.ZipFile(zip_content, 'w', zipfile.ZIP_DEFLATED) as generated_zip:
+        for file_path in sorted(Path(generated_path).glob('**/*')):
+            if file_path.is_file():
+                generated_zip.write(str(file_path), file_path.relative_to(generated_path).as_posix())
+    return zip_content.getvalue()
+
+def unpack_generated(zip_content, generated_path):
+    """Unzip in the generated folder, restoring the file modes"""
+    with zipfile.ZipFile(BytesIO(zip_content)) as generated_zip:
+        for zip_info in generated_zip.infolist():
+            extracted_path = generated_zip.extract(zip_info, generated_path)
+            mode = zip_info.external_attr >> 16
+            if mode:
+                os.chmod(extracted_path, mode & 0o777)
+
+def directory_store_get(store_dir, name):
+    """Read a file of the directory artifact store, None if not found"""
+    file_path = Path(store_dir, name)
+    try:
+        content = file_path.read_bytes()
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(str(file_path)) # Used as last access time for eviction
+    except OSError:
+        pass # Artifact of another user, or read-only store: best effort
+    return content
+
+def directory_store_put(store_dir, name, content):
+    """Write atomically a file of the directory artifact store"""
+    file_path = Path(store_dir, name)
+    if not file_path.parent.exists():
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=str(file_path.parent), suffix='.tmp', delete=False) as temp_fd:
+        temp_fd.write(content)
+    # NamedTemporaryFile is private (0600), the store is shared with other users
+    os.chmod(temp_fd.name, 0o666 & ~UMASK)
+    os.replace(temp_fd.name, str(file_path))
+
+def directory_store_evict(store_dir, max_size):
+    """Remove the least recently used artifacts until the store is under max_size bytes"""
+    artifacts = sorted(Path(store_dir).glob('*.zip'), key=lambda path: path.stat().st_mtime)
+    store_size = sum(artifact.stat().st_size for artifact in artifacts)
+    for artifact in artifacts:
+        if store_size <= max_size:
+            break
+        _LOGGER.info("Evict artifact %s from the store", artifact.name)
+        store_size -= artifact.stat().st_size
+        for file_path in (artifact, artifact.with_name(artifact.name + '.sha256')):
+            if file_path.exists():
+                file_path.unlink()
 
-            if initial_pr and local_conf['swagger'] not in swagger_files_in_pr:
-                _LOGGER.info("Skip file not in PR %s", project)
-                continue
+def http_store_get(store_url, name):
+    """Download a file of the HTTP artifact store, None if not found"""
+    import requests
+
+    response = requests.get('{}/{}'.format(store_url.rstrip('/'), name), timeout=ARTIFACT_STORE_TIMEOUT)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.content
+
+def http_store_put(store_url, name, content):
+    """Upload a file of the HTTP artifact store"""
+    import requests
+
+    response = requests.put('{}/{}'.format(store_url.rstrip('/'), name), data=content,
+                            timeout=ARTIFACT_STORE_TIMEOUT)
+    response.raise_for_status()
+
+def http_store_evict(store_url, max_size):
+    """Eviction is done by the HTTP server, max_size is not used"""
+
+ARTIFACT_STORE_BACKENDS = {
+    'directory': (directory_store_get, directory_store_put, directory_store_evict),
+    'http': (http_store_get, http_store_put, http_store_evict),
+}
+
+def get_artifact_store_backend(store_url):
+    """Get the backend of this store: http(s) URL or a directory.
+    :returns: The get, put and evict functions
+    :rtype: tuple"""
+    if re.match(r'https?://', store_url):
+        return ARTIFACT_STORE_BACKENDS['http']
+    return ARTIFACT_STORE_BACKENDS['directory']
+
+def fetch_generated(artifact_store, key, generated_path):
+    """Fetch the generated code of this key from the artifact store, checking its integrity.
+    A store failure is not fatal, the code will just be generated.
+
+    :param dict artifact_store: The store "url" and "max_size" in bytes
+    :returns: True if the generated code was found in the store
+    """
+    store_get, _, _ = get_artifact_store_backend(artifact_store['url'])
+    try:
+        zip_content = store_get(artifact_store['url'], key + '.zip')
+        if zip_content is None:
+            return False
+        digest = store_get(artifact_store['url'], key + '.zip.sha256')
+        if digest is None or digest.decode('utf-8').strip() != hashlib.sha256(zip_content).hexdigest():
+            _LOGGER.warning("Artifact %s is corrupted in the store, ignore it", key)
+            return False
+        unpack_generated(zip_content, generated_path)
+    except Exception as err:
+        _LOGGER.warning("Unable to fetch artifact %s from the store: %s", key, err)
+        if os.path.exists(generated_path):
+            shutil.rmtree(generated_path)
+        return False
+    _LOGGER.info("Generated code found in the artifact store: %s", key)
+    return True
+
+def publish_generated(artifact_store, key, generated_path):
+    """Publish the generated code of this key in the artifact store.
+    A store failure is not fatal, the generated code is still used.
+
+    :param dict artifact_store: The store "url" and "max_size" in bytes
+    """
+    _, store_put, store_evict = get_artifact_store_backend(artifact_store['url'])
+    zip_content = pack_generated(generated_path)
+    try:
+        store_put(artifact_store['url'], key + '.zip', zip_content)
+        # Digest is written last, an artifact without it is ignored
+        store_put(artifact_store['url'], key + '.zip.sha256',
+                  hashlib.sha256(zip_content).hexdigest().encode('utf-8'))
+        store_evict(artifact_store['url'], artifact_store['max_size'])
+    except Exception as err:
+        _LOGGER.warning("Unable to publish artifact %s to the store: %s", key, err)
+    else:
+        _LOGGER.info("Generated code published to the artifact store: %s", key)
+
+def load_journal(work_dir):
+    """Load the run journal of this work dir, an empty journal if there is none"""
+    journal_path = Path(work_dir, JOURNAL_FILE)
+    if not journal_path.exists():
+        return {'projects': {}}
+    with journal_path.open() as journal_fd:
+        return json.load(journal_fd)
+
+def save_journal(work_dir, journal):
+    """Save the run journal, atomically to survive a crash while writing"""
+    journal_path = Path(work_dir, JOURNAL_FILE)
+    temp_journal_path = journal_path.with_suffix('.tmp')
+    with temp_journal_path.open('w') as journal_fd:
+        json.dump(journal, journal_fd, indent=2, sort_keys=True)
+    os.replace(str(temp_journal_path), str(journal_path))
+
+def reset_journal(work_dir):
+    """Remove the journal and the generated code kept in this work dir"""
+    journal_path = Path(work_dir, JOURNAL_FILE)
+    if journal_path.exists():
+        journal_path.unlink()
+    generated_path = Path(work_dir, JOURNAL_GENERATED_DIR)
+    if generated_path.exists():
+        shutil.rmtree(str(generated_path), onerror=remove_readonly)
+
+def get_journal_generated_path(work_dir, journal, project, input_hash):
+    """Folder keeping the generated code of the project in the work dir.
+    Generated code from a previous run is removed if its inputs changed.
+    :rtype: str"""
+    generated_path = Path(work_dir, JOURNAL_GENERATED_DIR, project)
+    if journal['projects'].get(project, {}).get('input_hash') != input_hash:
+        journal['projects'].pop(project, None)
+        if generated_path.exists():
+            shutil.rmtree(str(generated_path), onerror=remove_readonly)
+    return str(generated_path)
+
+def parse_shard(shard):
+    """Parse a shard definition "i/N" where i is 1-based.
+
+    :rtype: tuple<int, int>"""
+    match = re.match(r'^(\d+)/(\d+)$', shard)
+    if not match:
+        raise ValueError('Shard must be "i/N", got: {}'.format(shard))
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError('Shard index must be between 1 and {}, got: {}'.format(count, index))
+    return index, count
+
+def load_project_durations(shard_dir):
+    """Load the per-project durations (in seconds) saved by the last merge in this shard dir."""
+    durations_path = Path(shard_dir, SHARD_DURATIONS_FILE)
+    if not durations_path.exists():
+        return {}
+    with durations_path.open() as durations_fd:
+        return json.load(durations_fd)
+
+def compute_project_costs(projects, restapi_git_folder, known_costs):
+    """Estimate the cost of each project, in the unit of known_costs
+    (duration in seconds to balance shards, peak RSS in bytes to order generations).
+
+    Known cost is used if available. Otherwise, the Swagger file size is used,
+    converted using the known projects ratio if any.
+    :rtype: dict"""
+    sizes = {}
+    for project, local_conf in projects.items():
+        swagger_file = os.path.join(restapi_git_folder, local_conf['swagger'])
+        sizes[project] = os.path.getsize(swagger_file) if os.path.isfile(swagger_file) else 0
 
-            _LOGGER.info("Working on %s", local_conf['swagger'])
-            dest = local_conf['output_dir']
-            swagger_file = os.path.join(restapi_git_folder, local_conf['swagger'])
+    known_projects = [project for project in projects if project in known_costs]
+    known_size = sum(sizes[project] for project in known_projects)
+    ratio = 1.
+    if known_size:
+        ratio = sum(known_costs[project] for project in known_projects) / known_size
 
-            if not os.path.isfile(swagger_file):
-                err_msg = "Swagger file does not exist or is not readable: {}".format(
-                    swagger_file)
-                _LOGGER.critical(err_msg)
-                raise ValueError(err_msg)
+    return {
+        project: known_costs[project] if project in known_costs else sizes[project] * ratio
+        for project in projects
+    }
 
-            dest_folder = os.path.join(sdk_repo.working_tree_dir, dest)
-            if not os.path.isdir(dest_folder):
-                err_msg = "Dest folder does not exist or is not accessible: {}".format(
-                    dest_folder)
-                _LOGGER.critical(err_msg)
-                raise ValueError(err_msg)
+def split_projects_in_shards(costs, shard_count):
+    """Split projects in shard_count lists with a balanced total cost.
+
+    Greedy "longest first" algorithm, deterministic for the same costs.
+    :rtype: list<list<str>>"""
+    shards = [[] for _ in range(shard_count)]
+    loads = [0.] * shard_count
+    for project in sorted(costs, key=lambda p: (-costs[p], p)):
+        lightest = min(range(shard_count), key=lambda i: (loads[i], i))
+        shards[lightest].append(project)
+        loads[lightest] += costs[project]
+    return shards
+
+def get_shard_partition(projects, shard_count, shard_dir, restapi_git_folder):
+    """Split the projects in shard_count shards.
+    Only inputs shared by every shard are used, so all shards compute the same partition.
+    :rtype: list<list<str>>"""
+    durations = load_project_durations(shard_dir)
+    costs = compute_project_costs(projects, restapi_git_folder, durations)
+    return split_projects_in_shards(costs, shard_count)
+
+def save_shard_output(shard_dir, shard, sdk_folder, projects, durations, hexsha, partition):
+    """Copy the output_dir of the built projects in the shard dir, with a manifest.
+    The manifest keeps the partition of all the selected projects, checked by the merge."""
+    index, count = shard
+    shard_path = Path(shard_dir, 'shard_{}'.format(index))
+    if shard_path.exists():
+        shutil.rmtree(str(shard_path), onerror=remove_readonly)
+    shard_path.mkdir(parents=True)
+
+    for local_conf in projects.values():
+        shutil.copytree(os.path.join(sdk_folder, local_conf['output_dir']),
+                        str(shard_path.joinpath('output', local_conf['output_dir'])))
+
+    # Manifest is written last and atomically, its presence means the shard is complete
+    manifest = {
+        'shard': index,
+        'shard_count': count,
+        'hexsha': hexsha,
+        'selected_projects': sorted(project for shard_projects in partition for project in shard_projects),
+        'partition': partition,
+        'projects': {
+            project: {
+                'output_dir': local_conf['output_dir'],
+                'duration': durations[project]
+            } for project, local_conf in projects.items()
+        }
+    }
+    manifest_path = shard_path.joinpath(SHARD_MANIFEST_FILE)
+    temp_manifest_path = manifest_path.with_suffix('.tmp')
+    with temp_manifest_path.open('w') as manifest_fd:
+        json.dump(manifest, manifest_fd, indent=2)
+    os.replace(str(temp_manifest_path), str(manifest_path))
+    _LOGGER.info("Shard %s/%s saved in %s", index, count, shard_path)
+
+def read_shard_manifests(shard_dir):
+    """Read the manifests of a shard dir, checking every shard is present.
+
+    :rtype: list<dict>"""
+    manifests = []
+    for manifest_path in sorted(Path(shard_dir).glob('shard_*/'+SHARD_MANIFEST_FILE)):
+        with manifest_path.open() as manifest_fd:
+            manifest = json.load(manifest_fd)
+        manifest['path'] = str(manifest_path.parent)
+        manifests.append(manifest)
+    if not manifests:
+        raise ValueError('No shard found in {}'.format(shard_dir))
+
+    shard_counts = {manifest['shard_count'] for manifest in manifests}
+    if len(shard_counts) != 1:
+        raise ValueError('Shards of {} have different shard counts: {}'.format(shard_dir, shard_counts))
+    missing = set(range(1, shard_counts.pop()+1)) - {manifest['shard'] for manifest in manifests}
+    if missing:
+        raise ValueError('Missing shards in {}: {}'.format(shard_dir, sorted(missing)))
+
+    hexshas = {manifest['hexsha'] for manifest in manifests}
+    if len(hexshas) != 1:
+        raise ValueError('Shards of {} were built from different REST SHA1: {}'.format(shard_dir, hexshas))
+
+    # Shards must agree on the projects, and build exactly their part of them
+    plans = {json.dumps([manifest['selected_projects'], manifest['partition']]) for manifest in manifests}
+    if len(plans) != 1:
+        raise ValueError('Shards of {} disagree on the projects to build'.format(shard_dir))
+    built_projects = []
+    for manifest in manifests:
+        expected_projects = manifest['partition'][manifest['shard']-1]
+        if sorted(manifest['projects']) != sorted(expected_projects):
+            raise ValueError('Shard {} of {} built {} instead of {}'.format(
+                manifest['shard'], shard_dir, sorted(manifest['projects']), sorted(expected_projects)))
+        built_projects.extend(manifest['projects'])
+    duplicates = {project for project in built_projects if built_projects.count(project) > 1}
+    if duplicates:
+        raise ValueError('Projects built by several shards of {}: {}'.format(shard_dir, sorted(duplicates)))
+    missing = set(manifests[0]['selected_projects']) - set(built_projects)
+    if missing:
+        raise ValueError('Projects built by no shard of {}: {}'.format(shard_dir, sorted(missing)))
+    return manifests
+
+def remove_wrappers(output_folder, global_conf, local_conf):
+    """Remove the wrapper files of a shard output, they come from the shard SDK clone."""
+    wrapper_files_or_dirs = merge_options(global_conf, local_conf, "wrapper_filesOrDirs") or []
+    for wrapper_file_or_dir in wrapper_files_or_dirs:
+        for file_path in Path(output_folder).glob(wrapper_file_or_dir):
+            if file_path.is_dir():
+                shutil.rmtree(str(file_path), onerror=remove_readonly)
+            elif file_path.exists():
+                file_path.unlink()
 
-            generated_path = os.path.join(temp_dir, os.path.basename(swagger_file))
+def merge_shard_outputs(shard_dir, sdk_folder, temp_dir, global_conf, projects_conf):
+    """Copy the output of every shard in the SDK folder.
+
+    Wrapper files are taken from the SDK folder, not from the shard.
+    The durations of this run are saved for the next sharding.
+    :returns: The REST SHA1 the shards were built from
+    :rtype: str"""
+    manifests = read_shard_manifests(shard_dir)
+
+    # Shard outputs are already relative to the generated base directory
+    global_conf = dict(global_conf, generated_relative_base_directory=None)
+    durations = load_project_durations(shard_dir)
+    for manifest in manifests:
+        _LOGGER.info("Merge shard %s/%s", manifest['shard'], manifest['shard_count'])
+        for project, project_manifest in manifest['projects'].items():
+            output_dir = project_manifest['output_dir']
+            dest_folder = os.path.join(sdk_folder, output_dir)
+            merged_path = os.path.join(temp_dir, 'shard_{}'.format(manifest['shard']), output_dir)
+            shutil.copytree(os.path.join(manifest['path'], 'output', output_dir), merged_path)
+            if not os.path.isdir(dest_folder):
+                os.makedirs(dest_folder)
+            local_conf = dict(projects_conf.get(project, {}), generated_relative_base_directory=None)
+            remove_wrappers(merged_path, global_conf, local_conf)
+            update(merged_path, dest_folder, global_conf, local_conf)
+            durations[project] = project_manifest['duration']
+
+    with Path(shard_dir, SHARD_DURATIONS_FILE).open('w') as durations_fd:
+        json.dump(durations, durations_fd, indent=2, sort_keys=True)
+    return manifests[0]['hexsha']
+
+def select_projects(config, project_pattern, initial_pr, swagger_files_in_pr):
+    """Return the projects of the configuration to build.
+    :rtype: dict"""
+    projects = {}
+    for project, local_conf in config["projects"].items():
+        if project_pattern and not any(project.startswith(p) for p in project_pattern):
+            _LOGGER.info("Skip project %s", project)
+            continue
+
+        if initial_pr and local_conf['swagger'] not in swagger_files_in_pr:
+            _LOGGER.info("Skip file not in PR %s", project)
+            continue
+        projects[project] = local_conf
+    return projects
+
+def check_project_paths(local_conf, restapi_git_folder, sdk_folder, sdk_index=None):
+    """Check that the Swagger file and the output_dir of the project exist.
+    If sdk_index is provided, the output_dir is checked in this index instead of the SDK folder."""
+    dest = local_conf['output_dir']
+    swagger_file = os.path.join(restapi_git_folder, local_conf['swagger'])
+
+    if not os.path.isfile(swagger_file):
+        err_msg = "Swagger file does not exist or is not readable: {}".format(
+            swagger_file)
+        _LOGGER.critical(err_msg)
+        raise ValueError(err_msg)
+
+    dest_folder = os.path.join(sdk_folder, dest)
+    if sdk_index is not None:
+        prefix = get_output_dir_prefix(dest)
+        dest_exists = any(path.startswith(prefix) for path, _ in sdk_index.entries)
+    else:
+        dest_exists = os.path.isdir(dest_folder)
+    if not dest_exists:
+        err_msg = "Dest folder does not exist or is not accessible: {}".format(
+            dest_folder)
+        _LOGGER.critical(err_msg)
+        raise ValueError(err_msg)
+
+
+def generate_project(language, local_conf, restapi_git_folder, temp_dir,
+                     autorest_exe_path, global_conf, resume_path=None, process_callback=None,
+                     artifact_store=None, artifact_key=None):
+    """Generate the code of one project in a new folder of temp_dir.
+    If resume_path is provided, the generated code is copied from this folder if it
+    exists, or kept in it otherwise.
+    If artifact_store is provided, the generated code is fetched from the store using
+    artifact_key if possible, or published to it otherwise.
+
+    :returns: The generated folder, the duration in seconds, if the generation was resumed
+     and if it was found in the artifact store
+    :rtype: dict"""
+    _LOGGER.info("Working on %s", local_conf['swagger'])
+    swagger_file = os.path.join(restapi_git_folder, local_conf['swagger'])
+    generated_path = os.path.join(tempfile.mkdtemp(dir=temp_dir), os.path.basename(swagger_file))
+
+    start_time = time.time()
+    resumed = bool(resume_path) and os.path.isdir(resume_path)
+    cached = False
+    if resumed:
+        _LOGGER.info("Resume generated code from %s", resume_path)
+        shutil.copytree(resume_path, generated_path)
+    else:
+        if artifact_store:
+            cached = fetch_generated(artifact_store, artifact_key, generated_path)
+        if not cached:
             generate_code(language,
                           swagger_file, generated_path,
-                          autorest_exe_path, global_conf, local_conf)
-            update(generated_path, dest_folder, global_conf, local_conf)
+                          autorest_exe_path, global_conf, local_conf,
+                          process_callback)
+            if artifact_store:
+                publish_generated(artifact_store, artifact_key, generated_path)
+        if resume_path:
+            shutil.copytree(generated_path, resume_path)
+    return {
+        'generated_path': generated_path,
+        'generate_duration': time.time() - start_time,
+        'resumed': resumed,
+        'cached': cached
+    }
+
+
+def update_project(generated_path, local_conf, sdk_folder, global_conf, sdk_index=None):
+    """Update the output_dir of the project in the SDK folder with the generated code.
+    If sdk_index is provided, this index is updated instead of the SDK folder.
+
+    :returns: The duration in seconds"""
+    start_time = time.time()
+    dest = local_conf['output_dir']
+    dest_folder = os.path.join(sdk_folder, dest)
+    if sdk_index is not None:
+        def read_dest_file(relative_path):
+            """Read from the index"""
+            entry = sdk_index.entries.get((get_output_dir_prefix(dest) + relative_path, 0))
+            return sdk_index.repo.odb.stream(entry.binsha).read() if entry else None
+        normalize_generated(generated_path, read_dest_file, global_conf, local_conf)
+        update_index(generated_path, sdk_index, dest, global_conf, local_conf)
+    else:
+        def read_dest_file(relative_path):
+            """Read from the SDK folder"""
+            dest_file = Path(dest_folder, relative_path)
+            return dest_file.read_bytes() if dest_file.is_file() else None
+        normalize_generated(generated_path, read_dest_file, global_conf, local_conf)
+        update(generated_path, dest_folder, global_conf, local_conf)
+    return time.time() - start_time
+
+
+def build_libraries(gh_token, config_path, project_pattern, restapi_git_folder,
+         sdk_git_id, pr_repo_id, message_template, base_branch_name, branch_name,
+         autorest_dir=None, shard=None, shard_dir=None, merge_shards=False,
+         history_db=None, object_db=False, work_dir=None, resume=False,
+         jobs=DEFAULT_JOBS, memory_reserve=DEFAULT_MEMORY_RESERVE,
+         artifact_store=None):
+    """Main method of the the file.
+
+    If shard is a (index, count) tuple, only this shard of the projects is built
+    and saved in shard_dir, without commit. If merge_shards is True, nothing is
+    built but the shards of shard_dir are gathered in one commit and PR.
+    If history_db is provided, the timing of each project is saved in this SQLite file.
+    If object_db is True, the SDK is cloned bare and the commit is built in the object
+    database, without working tree. Not compatible with sharding.
+    If work_dir is provided, a journal of the built projects is kept in it. With resume,
+    projects already built with the same inputs are not generated again.
+    Up to jobs Autorest processes run concurrently, if the system keeps memory_reserve
+    bytes of available memory.
+    If artifact_store is provided (dict with "url" and "max_size"), generated code is shared
+    with other runs through this store.
+    """
+    from git import Repo, GitCommandError
+    from git.index import IndexFile
 
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            clean_sdk_folder(os.path.join(temp_dir, 'sdk')) as sdk_folder, \
+            ThreadPoolExecutor(max_workers=STARTUP_WORKERS) as executor:
+
+        # Startup network operations run concurrently, a step waits only for the
+        # result of the steps it depends on.
+        sdk_git_id_future = executor.submit(get_full_sdk_id, gh_token, sdk_git_id)
+        initial_pr_future = executor.submit(get_initial_pr, gh_token)
+        branch_name_future = executor.submit(
+            lambda: compute_branch_name(branch_name, gh_token) if gh_token else None
+        )
+        clone_future = executor.submit(
+            lambda: clone_to_path(gh_token, temp_dir, sdk_git_id_future.result(), object_db)
+        )
+        if not merge_shards:
+            swagger_files_in_pr_future = executor.submit(
+                lambda: get_swagger_project_files_in_pr(initial_pr_future.result())
+                if initial_pr_future.result() else set()
+            )
+            autorest_future = executor.submit(
+                lambda: install_autorest_from_github_config(
+                    temp_dir, gh_token, sdk_git_id_future.result(), config_path,
+                    [branch_name_future.result(), base_branch_name], autorest_dir)
+            )
+
+        sdk_git_id = sdk_git_id_future.result()
+        clone_future.result()
+        sdk_repo = Repo(sdk_folder)
         if gh_token:
-            if do_commit(sdk_repo, message_template, branch_name, hexsha):
+            branch_name = branch_name_future.result()
+            _LOGGER.info('Destination branch for generated code is %s', branch_name)
+            configure_user(gh_token, sdk_repo)
+
+        if object_db:
+            _LOGGER.info('Object database mode, no checkout and no upstream repo sync')
+            base_commit = get_base_commit(sdk_repo, branch_name if gh_token else None,
+                                          base_branch_name)
+            sdk_index = IndexFile.from_tree(sdk_repo, base_commit)
+            config = read_config_from_tree(base_commit.tree, config_path)
+        else:
+            sdk_index = None
+            if gh_token:
+                try:
+                    _LOGGER.info('Try to checkout the destination branch if it already exists')
+                    sdk_repo.git.checkout(branch_name)
+                except GitCommandError:
+                    _LOGGER.info('Destination branch does not exists')
+                    sdk_repo.git.checkout(base_branch_name)
+                if shard:
+                    # Shards run concurrently, only the merge step pushes
+                    _LOGGER.info('Skipping the upstream repo sync for a shard')
+                else:
+                    sync_fork(gh_token, sdk_git_id, sdk_repo)
+            else:
+                _LOGGER.info('No token provided, simply checkout base branch')
+                sdk_repo.git.checkout(base_branch_name)
+
+            config = read_config(sdk_repo.working_tree_dir, config_path)
+
+        config_errors = validate_config(config)
+        if config_errors:
+            err_msg = "Invalid configuration {}:\n{}".format(config_path, "\n".join(config_errors))
+            _LOGGER.critical(err_msg)
+            raise ValueError(err_msg)
+        global_conf = config["meta"]
+        language = global_conf["language"]
+
+        if merge_shards:
+            hexsha = merge_shard_outputs(shard_dir, sdk_repo.working_tree_dir, temp_dir,
+                                         global_conf, config["projects"])
+        else:
+            hexsha = get_swagger_hexsha(restapi_git_folder)
+
+            initial_pr = initial_pr_future.result()
+            swagger_files_in_pr = swagger_files_in_pr_future.result()
+
+            projects = select_projects(config, project_pattern, initial_pr, swagger_files_in_pr)
+            if shard:
+                partition = get_shard_partition(projects, shard[1], shard_dir, restapi_git_folder)
+                projects = {project: projects[project] for project in partition[shard[0]-1]}
+                _LOGGER.info("Shard %s/%s will build: %s", shard[0], shard[1], ", ".join(projects))
+
+            autorest_exe_path = check_installed_autorest(autorest_future, temp_dir,
+                                                         global_conf, autorest_dir)
+
+            # Forced --autorest has no version, only its binary hash identifies it
+            autorest_version = None if autorest_dir else global_conf.get("autorest", LATEST_TAG)
+            autorest_hash = compute_file_hash(autorest_exe_path)
+            run_started = time.time()
+            if work_dir:
+                os.makedirs(work_dir, exist_ok=True)
+                if not resume:
+                    reset_journal(work_dir)
+                journal = load_journal(work_dir)
+            peak_rss = load_history_peak_rss(history_db) if history_db else {}
+            # Swagger size converted to bytes for the projects without peak RSS
+            memory_costs = compute_project_costs(projects, restapi_git_folder, peak_rss)
+            predicted_memory = predict_autorest_memory(projects, peak_rss)
+            generations = []
+            input_hashes = {}
+            # Biggest projects first
+            for project in sorted(projects, key=lambda p: (-memory_costs[p], p)):
+                local_conf = projects[project]
+                check_project_paths(local_conf, restapi_git_folder, sdk_folder, sdk_index)
+                resume_path = None
+                if work_dir or artifact_store:
+                    input_hashes[project] = compute_generation_hash(
+                        language, restapi_git_folder, global_conf, local_conf, autorest_hash)
+                if work_dir:
+                    resume_path = get_journal_generated_path(work_dir, journal, project,
+                                                             input_hashes[project])
+                generations.append((project, predicted_memory[project], functools.partial(
+                    generate_project, language, local_conf, restapi_git_folder, temp_dir,
+                    autorest_exe_path, global_conf, resume_path,
+                    artifact_store=artifact_store, artifact_key=input_hashes.get(project)
+                )))
+
+            durations = {}
+            for project, timing, project_peak_rss in schedule_generations(generations, jobs,
+                                                                          memory_reserve):
+                local_conf = projects[project]
+                timing['update_duration'] = update_project(timing.pop('generated_path'), local_conf,
+                                                           sdk_folder, global_conf, sdk_index)
+                if work_dir:
+                    if timing['resumed']:
+                        timing['generate_duration'] = journal['projects'][project]['generate_duration']
+                    journal['projects'][project] = {
+                        'input_hash': input_hashes[project],
+                        'generate_duration': timing['generate_duration']
+                    }
+                    save_journal(work_dir, journal)
+                durations[project] = timing['generate_duration'] + timing['update_duration']
+                if history_db and not timing['resumed'] and not timing['cached']:
+                    if sdk_index is not None:
+                        output_size, output_changed = get_index_output_stats(
+                            sdk_index, base_commit.tree, local_conf['output_dir'])
+                    else:
+                        dest_folder = os.path.join(sdk_folder, local_conf['output_dir'])
+                        output_size = get_folder_size(dest_folder)
+                        output_changed = bool(sdk_repo.git.status('--porcelain', '--', dest_folder))
+                    timing.update(
+                        autorest_version=autorest_version,
+                        autorest_hash=autorest_hash,
+                        spec_hash=compute_spec_hash(restapi_git_folder, local_conf['swagger']),
+                        output_size=output_size,
+                        output_changed=output_changed,
+                        peak_rss=project_peak_rss
+                    )
+                    record_project_timing(history_db, run_started, project, timing)
+
+        if shard:
+            save_shard_output(shard_dir, shard, sdk_repo.working_tree_dir,
+                              projects, durations, hexsha, partition)
+        elif gh_token:
+            if sdk_index is not None:
+                committed = do_commit_from_index(sdk_repo, sdk_index, base_commit,
+                                                 message_template, branch_name, hexsha)
+            else:
+                committed = do_commit(sdk_repo, message_template, branch_name, hexsha)
+            if committed:
                 sdk_repo.git.push('origin', branch_name, set_upstream=True)
                 if pr_repo_id:
                     do_pr(gh_token, sdk_git_id, pr_repo_id, branch_name, base_branch_name)
@@ -586,30 +1823,138 @@ def main():
     parser.add_argument("--debug",
                         dest="debug", action="store_true",
                         help="Verbosity in DEBUG mode")
-
-    parser.add_argument('sdk_git_id',
+    parser.add_argument('--shard',
+                        dest='shard', default=None,
+                        help='Build only the shard "i/N" of the projects and save it in --shard-dir. No commit is done.')
+    parser.add_argument('--merge-shards',
+                        dest='merge_shards', action="store_true",
+                        help='Merge the shards saved in --shard-dir in one commit and PR. No project is built.')
+    parser.add_argument('--shard-dir',
+                        dest='shard_dir', default=None,
+                        help='The directory used to exchange shard outputs. Required by --shard and --merge-shards')
+
+    parser.add_argument('--object-db',
+                        dest='object_db', action="store_true",
+                        help='Clone the SDK bare and build the commit in the git object database, without checkout nor upstream sync.')
+    parser.add_argument('--jobs', '-j',
+                        dest='jobs', type=int, default=DEFAULT_JOBS,
+                        help='Maximum number of concurrent Autorest processes [default: %(default)s]')
+    parser.add_argument('--memory-reserve',
+                        dest='memory_reserve', type=int, default=DEFAULT_MEMORY_RESERVE // (1024 * 1024),
+                        help='Available memory in MB to keep when starting a new Autorest process [default: %(default)s]')
+    parser.add_argument('--artifact-store',
+                        dest='artifact_store', default=None,
+                        help='Directory or http(s) URL of a store sharing the generated code between runs.')
+    parser.add_argument('--artifact-store-max-size',
+                        dest='artifact_store_max_size', type=int, default=None,
+                        help='Maximum size in MB of a directory --artifact-store [default: {}]'.format(
+                            DEFAULT_ARTIFACT_STORE_MAX_SIZE // (1024 * 1024)))
+    parser.add_argument('--work-dir',
+                        dest='work_dir', default=None,
+                        help='Persistent directory keeping a journal and the generated code of the built projects.')
+    parser.add_argument('--resume',
+                        dest='resume', action="store_true",
+                        help='Do not generate again the projects of the --work-dir journal whose inputs did not change.')
+    parser.add_argument('--validate-config',
+                        dest='validate_config', action="store_true",
+                        help='Validate the local --config file and exit. No SDK id needed.')
+    parser.add_argument('--list-projects',
+                        dest='list_projects', action="store_true",
+                        help='List the projects of the local --config file matching --project and exit. No SDK id needed.')
+    parser.add_argument('--history',
+                        dest='history_db', default=None,
+                        help='SQLite file where the timing of each project is saved.')
+    parser.add_argument('--history-report',
+                        dest='history_report', action="store_true",
+                        help='Print the projects whose generation time regressed in --history and exit. No SDK id needed.')
+    parser.add_argument('--regression-threshold',
+                        dest='regression_threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='Regression ratio over the median of the last runs for --history-report [default: %(default)s]')
+
+    parser.add_argument('sdk_git_id', nargs='?',
                         help='The SDK Github id. '\
                          'If a simple string, consider it belongs to the GH_TOKEN owner repo. '\
                          'Otherwise, you can use the syntax username/repoid')
 
     args = parser.parse_args()
 
-    if 'GH_TOKEN' not in os.environ:
-        gh_token = None
-    else:
-        gh_token = os.environ['GH_TOKEN']
-
     main_logger = logging.getLogger()
     if args.verbose or args.debug:
         logging.basicConfig()
         main_logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
 
+    if args.validate_config or args.list_projects:
+        try:
+            config = read_config('.', args.config_path)
+        except (OSError, ValueError) as err:
+            print("Unable to read {}: {}".format(args.config_path, err))
+            sys.exit(1)
+        config_errors = validate_config(config)
+        for config_error in config_errors:
+            print(config_error)
+        if config_errors:
+            sys.exit(1)
+        if args.list_projects:
+            for project in sorted(select_projects(config, args.project, None, set())):
+                print(project)
+        else:
+            print("{} is valid".format(args.config_path))
+        sys.exit(0)
+    if args.history_report:
+        if not args.history_db:
+            parser.error('--history is required by --history-report')
+        regressions_found = print_history_report(args.history_db, args.regression_threshold)
+        sys.exit(1 if regressions_found else 0)
+    if not args.sdk_git_id:
+        parser.error('sdk_git_id is required')
+
+    artifact_store = None
+    if args.artifact_store:
+        max_size = args.artifact_store_max_size
+        if get_artifact_store_backend(args.artifact_store) == ARTIFACT_STORE_BACKENDS['http']:
+            if max_size is not None:
+                _LOGGER.warning('--artifact-store-max-size is ignored for an HTTP store, eviction is done by the server')
+        elif max_size is None:
+            max_size = DEFAULT_ARTIFACT_STORE_MAX_SIZE // (1024 * 1024)
+        artifact_store = {
+            'url': args.artifact_store,
+            'max_size': max_size * 1024 * 1024 if max_size is not None else None
+        }
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.resume and not args.work_dir:
+        parser.error('--work-dir is required by --resume')
+
+    shard = None
+    if args.object_db and (args.shard or args.merge_shards):
+        parser.error('--object-db is not compatible with --shard and --merge-shards')
+    if args.shard or args.merge_shards:
+        if args.shard and args.merge_shards:
+            parser.error('--shard and --merge-shards are exclusive')
+        if not args.shard_dir:
+            parser.error('--shard-dir is required by --shard and --merge-shards')
+        if args.shard:
+            try:
+                shard = parse_shard(args.shard)
+            except ValueError as err:
+                parser.error(str(err))
+
+    if 'GH_TOKEN' not in os.environ:
+        gh_token = None
+    else:
+        gh_token = os.environ['GH_TOKEN']
+
     build_libraries(gh_token,
                     args.config_path, args.project,
                     args.restapi_git_folder, args.sdk_git_id,
                     args.pr_repo_id,
                     args.message, args.base_branch, args.branch,
-                    args.autorest_dir)
+                    args.autorest_dir,
+                    shard, args.shard_dir, args.merge_shards,
+                    args.history_db, args.object_db,
+                    args.work_dir, args.resume,
+                    args.jobs, args.memory_reserve * 1024 * 1024,
+                    artifact_store)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,40 @@
+"""Benchmark the import time of SwaggerToSdk.
+
+The script is imported in a fresh interpreter for each run, since each worker
+process of a CI run pays this cost. The heavy dependencies are measured too,
+to show what the lazy imports save.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+IMPORTS = [
+    ('SwaggerToSdk', 'import SwaggerToSdk'),
+    ('SwaggerToSdk + validate config', 'import SwaggerToSdk; SwaggerToSdk.validate_config({})'),
+    ('requests, git, github', 'import requests, git, github'),
+]
+
+def time_import(statement, runs):
+    """Median time in ms of the statement in a fresh interpreter, minus interpreter startup"""
+    timer = 'import time; start = time.perf_counter(); {}; print(time.perf_counter() - start)'
+    durations = [
+        float(subprocess.check_output([sys.executable, '-c', timer.format(statement)],
+                                      universal_newlines=True))
+        for _ in range(runs)
+    ]
+    return statistics.median(durations) * 1000
+
+def main():
+    """Main method"""
+    parser = argparse.ArgumentParser(description='Benchmark the import time of SwaggerToSdk.')
+    parser.add_argument('--runs', '-n',
+                        dest='runs', type=int, default=10,
+                        help='Number of runs per import [default: %(default)s]')
+    args = parser.parse_args()
+
+    for name, statement in IMPORTS:
+        print("{:<35} {:8.1f} ms".format(name, time_import(statement, args.runs)))
+
+if __name__ == "__main__":
+    main()
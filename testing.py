@@ -1,7 +1,17 @@
 import unittest
 import os
+import re
+import json
+import sqlite3
+import threading
+import time
 import logging
 import tempfile
+import subprocess
+from concurrent.futures import Future
+from unittest import mock
+from contextlib import closing
+import sys
 from pathlib import Path
 logging.basicConfig(level=logging.INFO)
 
@@ -10,6 +20,10 @@ os.environ['TRAVIS'] = 'true'
 
 from SwaggerToSdk import *
 
+from git import Repo
+from git.index import IndexFile
+from github import Github, GithubException
+
 if not 'GH_TOKEN' in os.environ:
     raise Exception('GH_TOKEN must be defined to do the unitesting')
 GH_TOKEN = os.environ['GH_TOKEN']
@@ -274,6 +288,652 @@ class TestSwaggerToSDK(unittest.TestCase):
             self.assertFalse(Path(output, 'dont_need_this.txt').exists())
             self.assertFalse(Path(output, 'del_folder').exists())
 
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('1/4'), (1, 4))
+        self.assertEqual(parse_shard('4/4'), (4, 4))
+        for bad_shard in ['0/4', '5/4', '1', 'a/b', '1/0']:
+            with self.assertRaises(ValueError):
+                parse_shard(bad_shard)
+
+    def test_split_projects_in_shards(self):
+        costs = {'a': 10, 'b': 6, 'c': 5, 'd': 4, 'e': 1}
+        shards = split_projects_in_shards(costs, 2)
+        self.assertListEqual(shards, [['a', 'd'], ['b', 'c', 'e']])
+        self.assertListEqual(shards, split_projects_in_shards(costs, 2))
+
+        shards = split_projects_in_shards({'a': 1}, 3)
+        self.assertListEqual(shards, [['a'], [], []])
+
+    def test_compute_project_costs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            Path(temp_dir, 'a.json').write_bytes(b'x' * 100)
+            Path(temp_dir, 'b.json').write_bytes(b'x' * 300)
+            projects = {'a': {'swagger': 'a.json'}, 'b': {'swagger': 'b.json'}}
+
+            costs = compute_project_costs(projects, temp_dir, {})
+            self.assertDictEqual(costs, {'a': 100, 'b': 300})
+
+            costs = compute_project_costs(projects, temp_dir, {'a': 2.})
+            self.assertDictEqual(costs, {'a': 2., 'b': 6.})
+
+    def test_get_shard_partition(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            projects = {}
+            for index, project in enumerate('abcdef'):
+                Path(temp_dir, project + '.json').write_bytes(b'x' * (index + 1))
+                projects[project] = {'swagger': project + '.json'}
+            Path(temp_dir, SHARD_DURATIONS_FILE).write_text(json.dumps({'a': 100., 'b': 1.}))
+
+            partition = get_shard_partition(projects, 2, temp_dir, temp_dir)
+            self.assertEqual(len(partition), 2)
+            self.assertFalse(set(partition[0]) & set(partition[1]))
+            self.assertSetEqual(set(partition[0]) | set(partition[1]), set(projects))
+
+    def test_shard_output(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shard_dir = Path(temp_dir, 'shards')
+            sdk_folder = Path(temp_dir, 'sdk')
+            Path(sdk_folder, 'output_a').mkdir(parents=True)
+            Path(sdk_folder, 'output_a', 'generated.txt').write_bytes(b'a')
+            # Wrapper folder of the shard SDK clone
+            Path(sdk_folder, 'output_a', 'tests').mkdir()
+            Path(sdk_folder, 'output_a', 'tests', 't.py').write_bytes(b'shard')
+            Path(sdk_folder, 'output_b').mkdir(parents=True)
+            Path(sdk_folder, 'output_b', 'generated.txt').write_bytes(b'b')
+
+            partition = [['a'], ['b']]
+            save_shard_output(str(shard_dir), (1, 2), str(sdk_folder),
+                              {'a': {'output_dir': 'output_a'}}, {'a': 2.}, 'hexsha', partition)
+            with self.assertRaises(ValueError):
+                read_shard_manifests(str(shard_dir))
+
+            # Shard 2 computed another partition, "b" would be built by no shard
+            save_shard_output(str(shard_dir), (2, 2), str(sdk_folder),
+                              {}, {}, 'hexsha', [['a', 'b'], []])
+            with self.assertRaisesRegex(ValueError, 'disagree'):
+                read_shard_manifests(str(shard_dir))
+            # Shard 2 did not build its part
+            save_shard_output(str(shard_dir), (2, 2), str(sdk_folder),
+                              {}, {}, 'hexsha', partition)
+            with self.assertRaisesRegex(ValueError, 'instead of'):
+                read_shard_manifests(str(shard_dir))
+
+            save_shard_output(str(shard_dir), (2, 2), str(sdk_folder),
+                              {'b': {'output_dir': 'output_b'}}, {'b': 3.}, 'hexsha', partition)
+            self.assertListEqual(list(Path(shard_dir, 'shard_2').glob('*.tmp')), [])
+
+            merge_folder = Path(temp_dir, 'merge')
+            Path(merge_folder, 'output_a').mkdir(parents=True)
+            Path(merge_folder, 'output_a', 'wrapper.txt').write_bytes(b'wrapper')
+            Path(merge_folder, 'output_a', 'erase.txt').write_bytes(b'old')
+            Path(merge_folder, 'output_a', 'tests').mkdir()
+            Path(merge_folder, 'output_a', 'tests', 't.py').write_bytes(b'merge')
+            merge_temp = Path(temp_dir, 'merge_temp')
+            merge_temp.mkdir()
+
+            hexsha = merge_shard_outputs(str(shard_dir), str(merge_folder), str(merge_temp),
+                                         {'wrapper_filesOrDirs': ['wrapper.txt', 'tests']}, {})
+            self.assertEqual(hexsha, 'hexsha')
+            self.assertEqual(Path(merge_folder, 'output_a', 'generated.txt').read_bytes(), b'a')
+            self.assertTrue(Path(merge_folder, 'output_a', 'wrapper.txt').exists())
+            self.assertEqual(Path(merge_folder, 'output_a', 'tests', 't.py').read_bytes(), b'merge')
+            self.assertFalse(Path(merge_folder, 'output_a', 'erase.txt').exists())
+            self.assertEqual(Path(merge_folder, 'output_b', 'generated.txt').read_bytes(), b'b')
+            self.assertDictEqual(load_project_durations(str(shard_dir)), {'a': 2., 'b': 3.})
+
+    def test_compute_spec_hash(self):
+        spec_hash = compute_spec_hash('.', 'test/compositeGraphRbacManagementClient.json')
+        self.assertEqual(len(spec_hash), 40)
+        self.assertEqual(spec_hash, compute_spec_hash('.', 'test/compositeGraphRbacManagementClient.json'))
+
+    def test_compute_spec_hash_references(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            Path(temp_dir, 'common').mkdir()
+            Path(temp_dir, 'api').mkdir()
+            Path(temp_dir, 'api', 'swagger.json').write_text(json.dumps({
+                'definitions': {
+                    'Resource': {'$ref': '../common/types.json#/definitions/Resource'},
+                    'Local': {'$ref': '#/definitions/Resource'},
+                    'Remote': {'$ref': 'https://example.com/remote.json#/definitions/Remote'}
+                }
+            }))
+            Path(temp_dir, 'common', 'types.json').write_text(json.dumps({
+                'definitions': {'Resource': {'$ref': 'base.json#/definitions/Base'}}
+            }))
+            Path(temp_dir, 'common', 'base.json').write_text('{"v": 1}')
+
+            self.assertListEqual(get_swagger_references(Path(temp_dir, 'api', 'swagger.json')),
+                                 [Path(temp_dir, 'common', 'types.json')])
+            spec_hash = compute_spec_hash(temp_dir, 'api/swagger.json')
+            self.assertEqual(spec_hash, compute_spec_hash(temp_dir, 'api/swagger.json'))
+
+            # Shared definition changed, two references away
+            Path(temp_dir, 'common', 'base.json').write_text('{"v": 2}')
+            self.assertNotEqual(spec_hash, compute_spec_hash(temp_dir, 'api/swagger.json'))
+
+    def test_history(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history_db = str(Path(temp_dir, 'history.db'))
+            timing = {
+                'autorest_version': 'latest',
+                'spec_hash': 'hash',
+                'generate_duration': 10.,
+                'update_duration': 1.,
+                'output_size': 1024,
+                'output_changed': True
+            }
+            for run_started in range(3):
+                record_project_timing(history_db, run_started, 'stable', timing)
+                record_project_timing(history_db, run_started, 'slower', timing)
+            record_project_timing(history_db, 3, 'stable', dict(timing, generate_duration=12.))
+            record_project_timing(history_db, 3, 'slower', dict(timing, generate_duration=20., spec_hash='new'))
+
+            regressions = find_regressions(history_db, 0.5)
+            self.assertEqual(len(regressions), 1)
+            self.assertEqual(regressions[0]['project'], 'slower')
+            self.assertEqual(regressions[0]['baseline'], 10.)
+            self.assertTrue(regressions[0]['spec_changed'])
+            self.assertFalse(regressions[0]['autorest_changed'])
+
+            self.assertFalse(find_regressions(history_db, 1.5))
+
+    def test_match_wrapper_pattern(self):
+        self.assertTrue(match_wrapper_pattern('to_keep.txt', 'to_keep.txt'))
+        self.assertTrue(match_wrapper_pattern('to_keep_pattern.txt', 'to_*_pattern.txt'))
+        self.assertTrue(match_wrapper_pattern('folder/inside/file.txt', 'folder'))
+        self.assertTrue(match_wrapper_pattern('sub/myfile1.py', '*/myfile?.py'))
+        self.assertFalse(match_wrapper_pattern('myfile1.py', '*/myfile?.py'))
+        self.assertFalse(match_wrapper_pattern('sub/other.txt', 'to_keep.txt'))
+
+    def test_do_commit_from_index(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            work_repo = Repo.init(str(Path(temp_dir, 'work')))
+            work_repo.git.config('user.email', 'you@example.com')
+            work_repo.git.config('user.name', 'Your Name')
+            output = Path(temp_dir, 'work', 'output')
+            output.mkdir()
+            Path(output, 'to_keep.txt').write_bytes(b'My content')
+            Path(output, 'erase.txt').write_bytes(b'My content')
+            Path(output, 'generated.txt').write_bytes(b'Same content')
+            work_repo.git.add(work_repo.working_tree_dir)
+            work_repo.index.commit('Initial')
+            work_repo.git.branch('-M', 'master')
+
+            repo = Repo.clone_from(work_repo.working_tree_dir, str(Path(temp_dir, 'bare')), bare=True)
+            repo.git.config('user.email', 'you@example.com')
+            repo.git.config('user.name', 'Your Name')
+            base_commit = get_base_commit(repo, 'testing', 'master')
+            self.assertEqual(base_commit.hexsha, work_repo.head.commit.hexsha)
+
+            def generate(content):
+                generated = Path(temp_dir, 'generated')
+                generated.mkdir()
+                Path(generated, 'generated.txt').write_bytes(content)
+                Path(generated, 'to_keep.txt').write_bytes(b'Generated content')
+                return str(generated)
+
+            conf = {'wrapper_filesOrDirs': ['to_keep.txt']}
+            sdk_index = IndexFile.from_tree(repo, base_commit)
+            update_index(generate(b'Same content'), sdk_index, 'output', conf, {})
+            self.assertEqual(get_index_output_stats(sdk_index, base_commit.tree, 'output'), (22, True))
+            self.assertTrue(do_commit_from_index(repo, sdk_index, base_commit, 'Test {hexsha}', 'testing', 'fakehexsha'))
+
+            commit = repo.heads['testing'].commit
+            self.assertEqual(commit.message, 'Test fakehexsha')
+            self.assertListEqual(list(commit.parents), [base_commit])
+            self.assertSetEqual(set(commit.stats.files), {'output/erase.txt'})
+            self.assertEqual((commit.tree / 'output/to_keep.txt').data_stream.read(), b'My content')
+
+            base_commit = get_base_commit(repo, 'testing', 'master')
+            self.assertEqual(base_commit, commit)
+            sdk_index = IndexFile.from_tree(repo, base_commit)
+            update_index(generate(b'Same content'), sdk_index, 'output', conf, {})
+            self.assertFalse(do_commit_from_index(repo, sdk_index, base_commit, 'Test {hexsha}', 'testing', 'hexsha_not_used'))
+            self.assertEqual(repo.heads['testing'].commit, commit)
+
+    def test_update_index_same_as_update(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            work_repo = Repo.init(str(Path(temp_dir, 'work')))
+            work_repo.git.config('user.email', 'you@example.com')
+            work_repo.git.config('user.name', 'Your Name')
+            output = Path(temp_dir, 'work', 'output')
+            Path(output, 'tests').mkdir(parents=True)
+            Path(output, 'tests', 'test_a.py').write_bytes(b'Wrapper test')
+            Path(output, 'folder').mkdir()
+            Path(output, 'folder', 'wrapper.py').write_bytes(b'Wrapper folder')
+            Path(output, 'erase.txt').write_bytes(b'My content')
+            work_repo.git.add(work_repo.working_tree_dir)
+            work_repo.index.commit('Initial')
+
+            def generate():
+                generated = Path(temp_dir, 'generated')
+                Path(generated, 'tests').mkdir(parents=True)
+                Path(generated, 'tests', 'test_a.py').write_bytes(b'Generated test')
+                Path(generated, 'tests', 'test_b.py').write_bytes(b'Generated test')
+                Path(generated, 'generated.py').write_bytes(b'Generated')
+                return str(generated)
+
+            conf = {'wrapper_filesOrDirs': ['tests/*', 'folder']}
+            sdk_index = IndexFile.from_tree(work_repo, work_repo.head.commit)
+            update_index(generate(), sdk_index, 'output', conf, {})
+            index_files = {path[len('output/'):]: work_repo.odb.stream(entry.binsha).read()
+                           for (path, _), entry in sdk_index.entries.items()}
+
+            update(generate(), str(output), conf, {})
+            tree_files = {path.relative_to(output).as_posix(): path.read_bytes()
+                          for path in output.glob('**/*') if path.is_file()}
+            self.assertDictEqual(index_files, tree_files)
+            self.assertEqual(tree_files['tests/test_a.py'], b'Wrapper test')
+            self.assertEqual(tree_files['tests/test_b.py'], b'Generated test')
+            self.assertNotIn('erase.txt', tree_files)
+
+            with self.assertRaises(ValueError):
+                update_index(generate(), sdk_index, 'output', {'wrapper_filesOrDirs': ['**/*.py']}, {})
+
+    def test_lazy_imports(self):
+        loaded = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, SwaggerToSdk; print(sorted(m for m in ("git", "github", "requests") if m in sys.modules))'],
+            universal_newlines=True)
+        self.assertEqual(loaded.strip(), '[]')
+
+    def test_validate_config(self):
+        config = {
+            'meta': {'language': 'Python', 'autorest_options': {'ft': 2}},
+            'projects': {
+                'authorization': {
+                    'swagger': 'arm-authorization/2015-07-01/swagger/authorization.json',
+                    'output_dir': 'azure-mgmt-authorization/azure/mgmt/authorization',
+                    'wrapper_filesOrDirs': ['myfile.py']
+                }
+            }
+        }
+        self.assertListEqual(validate_config(config), [])
+
+        self.assertListEqual(validate_config([]), ['Configuration must be a JSON object'])
+        self.assertListEqual(validate_config({}), ['"meta" must be an object', '"projects" must be an object'])
+
+        errors = validate_config({
+            'meta': {'wrapper_filesOrDirs': 'myfile.py'},
+            'projects': {'authorization': {'swagger': 'swagger.json', 'autorest_options': []}}
+        })
+        self.assertListEqual(errors, [
+            '"meta" must define "language"',
+            'meta "wrapper_filesOrDirs" must be a list',
+            'project "authorization" must define "output_dir"',
+            'project "authorization" "autorest_options" must be an object'
+        ])
+
+        errors = validate_config({
+            'meta': {'language': 'Python', 'normalize_lines': ['^# Date: ', '(unclosed', 42]},
+            'projects': {}
+        })
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0].startswith('''meta "normalize_lines" has an invalid regexp '(unclosed':'''))
+        self.assertEqual(errors[1], 'meta "normalize_lines" must be a list of strings')
+
+    def test_normalize_generated(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            generated = Path(temp_dir, 'generated')
+            Path(generated, 'inside').mkdir(parents=True)
+            Path(generated, 'inside', 'churn.py').write_bytes(b'# AutoRest 1.0.1\n# Date: 2016-05-12\nx = 1\n')
+            Path(generated, 'inside', 'changed.py').write_bytes(b'# AutoRest 1.0.1\nx = 2\n')
+            Path(generated, 'inside', 'new.py').write_bytes(b'# AutoRest 1.0.1\n')
+            dest = {
+                'churn.py': b'# AutoRest 1.0.0\n# Date: 2016-05-11\nx = 1\n',
+                'changed.py': b'# AutoRest 1.0.0\nx = 1\n',
+            }
+            global_conf = {
+                'normalize_lines': ['^# AutoRest ', '^# Date: '],
+                'generated_relative_base_directory': 'inside'
+            }
+
+            restored = normalize_generated(str(generated), dest.get, global_conf, {})
+            self.assertEqual(restored, 1)
+            self.assertEqual(Path(generated, 'inside', 'churn.py').read_bytes(), dest['churn.py'])
+            self.assertEqual(Path(generated, 'inside', 'changed.py').read_bytes(), b'# AutoRest 1.0.1\nx = 2\n')
+            self.assertEqual(Path(generated, 'inside', 'new.py').read_bytes(), b'# AutoRest 1.0.1\n')
+
+            self.assertEqual(normalize_generated(str(generated), dest.get, {}, {}), 0)
+
+    def test_is_normalized_diff(self):
+        rules = [re.compile(b'^# Date: ')]
+        self.assertTrue(is_normalized_diff(b'# Date: 1\nx\n', b'# Date: 2\nx\n', rules))
+        self.assertFalse(is_normalized_diff(b'# Date: 1\nx\n', b'# Date: 2\ny\n', rules))
+        self.assertFalse(is_normalized_diff(b'# Date: 1\nx\n', b'x\n', rules))
+        self.assertFalse(is_normalized_diff(b'# Date: 1\n', b'# Author\n', rules))
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            journal = load_journal(temp_dir)
+            self.assertDictEqual(journal, {'projects': {}})
+
+            generated_path = get_journal_generated_path(temp_dir, journal, 'project', 'hash')
+            Path(generated_path).mkdir(parents=True)
+            journal['projects']['project'] = {'input_hash': 'hash', 'generate_duration': 1.}
+            save_journal(temp_dir, journal)
+
+            journal = load_journal(temp_dir)
+            self.assertEqual(get_journal_generated_path(temp_dir, journal, 'project', 'hash'), generated_path)
+            self.assertTrue(Path(generated_path).exists())
+
+            # Inputs changed, generated code is invalidated
+            get_journal_generated_path(temp_dir, journal, 'project', 'new_hash')
+            self.assertFalse(Path(generated_path).exists())
+            self.assertDictEqual(journal, {'projects': {}})
+
+            Path(generated_path).mkdir(parents=True)
+            reset_journal(temp_dir)
+            self.assertFalse(Path(generated_path).exists())
+            self.assertDictEqual(load_journal(temp_dir), {'projects': {}})
+
+    def test_compute_generation_hash(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            Path(temp_dir, 'swagger.json').write_text('{}')
+            local_conf = {'swagger': 'swagger.json', 'output_dir': 'output'}
+            autorest_exe_path = Path(temp_dir, 'AutoRest.exe')
+
+            autorest_exe_path.write_bytes(b'AutoRest 1')
+            input_hash = compute_generation_hash('Python', temp_dir, {}, local_conf,
+                                                 compute_file_hash(autorest_exe_path))
+            self.assertEqual(input_hash, compute_generation_hash('Python', temp_dir, {}, local_conf,
+                                                                 compute_file_hash(autorest_exe_path)))
+
+            # "latest" moved to a new AutoRest: kept output is invalidated
+            autorest_exe_path.write_bytes(b'AutoRest 2')
+            self.assertNotEqual(input_hash, compute_generation_hash('Python', temp_dir, {}, local_conf,
+                                                                    compute_file_hash(autorest_exe_path)))
+
+    def test_generate_project_resume(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            Path(temp_dir, 'swagger.json').write_text('{}')
+            Path(temp_dir, 'sdk', 'output').mkdir(parents=True)
+            Path(temp_dir, 'sdk', 'output', 'old.txt').write_text('old')
+            Path(temp_dir, 'temp').mkdir()
+            resume_path = Path(temp_dir, 'work', 'generated', 'project')
+            resume_path.mkdir(parents=True)
+            Path(resume_path, 'generated.txt').write_text('generated')
+
+            local_conf = {'swagger': 'swagger.json', 'output_dir': 'output'}
+            check_project_paths(local_conf, temp_dir, str(Path(temp_dir, 'sdk')))
+            timing = generate_project('Python', local_conf, temp_dir, str(Path(temp_dir, 'temp')),
+                                      'AutoRest.exe', {}, resume_path=str(resume_path))
+            self.assertTrue(timing['resumed'])
+            update_project(timing['generated_path'], local_conf, str(Path(temp_dir, 'sdk')), {})
+            self.assertEqual(Path(temp_dir, 'sdk', 'output', 'generated.txt').read_text(), 'generated')
+            self.assertFalse(Path(temp_dir, 'sdk', 'output', 'old.txt').exists())
+            self.assertTrue(Path(resume_path, 'generated.txt').exists())
+
+    def test_check_installed_autorest(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            autorest_future = Future()
+            autorest_future.set_result(('AutoRest.exe', '0.16.0-Nightly20160410'))
+            exe_path = check_installed_autorest(autorest_future, temp_dir, {'autorest': '0.16.0-Nightly20160410'})
+            self.assertEqual(exe_path, 'AutoRest.exe')
+
+            Path(temp_dir, 'AutoRest.exe').write_text("I'm not a virus")
+            autorest_future = Future()
+            autorest_future.set_exception(ValueError('Github API failed'))
+            exe_path = check_installed_autorest(autorest_future, temp_dir, {}, autorest_dir=temp_dir)
+            self.assertEqual(exe_path, str(Path(temp_dir, 'AutoRest.exe')))
+
+            autorest_future = Future()
+            autorest_future.set_result((str(Path(temp_dir, 'AutoRest.exe')), None))
+            exe_path = check_installed_autorest(autorest_future, temp_dir, {'autorest': 'ignored'}, autorest_dir=temp_dir)
+            self.assertEqual(exe_path, str(Path(temp_dir, 'AutoRest.exe')))
+
+    def test_read_config_from_github(self):
+        config = read_config_from_github(GH_TOKEN, 'Azure/azure-sdk-for-python', 'swagger_to_sdk_config.json',
+                                         [None, 'notabranch', 'master'])
+        self.assertEqual(config['meta']['language'], 'Python')
+
+    def test_find_merged_pr(self):
+        class FakePull:
+            def __init__(self, number, merged):
+                self.number = number
+                self.merged = merged
+
+        class FakeRepo:
+            def __init__(self):
+                self.calls = []
+            def get_pull(self, number):
+                self.calls.append(number)
+                if number == 1:
+                    raise GithubException(404, 'Not Found', None)
+                return FakePull(number, number != 2)
+
+        repo = FakeRepo()
+        self.assertEqual(find_merged_pr(repo, ['1', '2', '3', '2', '4']).number, 3)
+        self.assertListEqual(sorted(repo.calls), [1, 2, 3, 4])
+        self.assertIsNone(find_merged_pr(repo, ['1', '2']))
+        self.assertIsNone(find_merged_pr(repo, []))
+
+        # Only "Not Found" means this is not a PR
+        repo.get_pull = mock.Mock(side_effect=GithubException(403, 'Rate limit', None))
+        with self.assertRaises(GithubException):
+            find_merged_pr(repo, ['1'])
+
+    def test_get_pr_from_travis_commit_sha_cache(self):
+        os.environ['TRAVIS_REPO_SLUG'] = 'Azure/azure-sdk-for-python'
+        os.environ['TRAVIS_COMMIT'] = 'cachedsha'
+        with tempfile.TemporaryDirectory() as temp_dir, mock.patch('SwaggerToSdk.CACHE_DIR', temp_dir):
+            cache_path = get_initial_pr_cache_path('Azure/azure-sdk-for-python', 'cachedsha')
+            cache_path.parent.mkdir(parents=True)
+
+            cache_path.write_text(json.dumps({'pr': {'number': 568}}))
+            pr_obj = get_pr_from_travis_commit_sha()
+            self.assertEqual(pr_obj.number, 568)
+
+            cache_path.write_text(json.dumps({'pr': None}))
+            self.assertIsNone(get_pr_from_travis_commit_sha())
+
+            # Truncated cache is a cache miss, failed lookup is not cached
+            cache_path.write_text('{"pr": {"num')
+            github_repo = mock.Mock()
+            github_repo.get_commit.return_value.commit.message = 'Merge #568'
+            github_repo.get_pull.side_effect = GithubException(500, 'Server Error', None)
+            with mock.patch('github.Github') as github_mock:
+                github_mock.return_value.get_repo.return_value = github_repo
+                self.assertIsNone(get_pr_from_travis_commit_sha())
+                self.assertEqual(cache_path.read_text(), '{"pr": {"num')
+
+                github_repo.get_pull.side_effect = None
+                github_repo.get_pull.return_value = mock.Mock(merged=True, number=568, raw_data={'number': 568})
+                self.assertEqual(get_pr_from_travis_commit_sha().number, 568)
+
+                # Unwritable cache is not fatal
+                Path(temp_dir, 'not_a_dir').write_text('')
+                with mock.patch('SwaggerToSdk.CACHE_DIR', str(Path(temp_dir, 'not_a_dir'))):
+                    self.assertEqual(get_pr_from_travis_commit_sha().number, 568)
+            self.assertDictEqual(json.loads(cache_path.read_text()), {'pr': {'number': 568}})
+            self.assertListEqual(list(cache_path.parent.glob('*.tmp')), [])
+
+    def test_get_initial_pr_concurrent(self):
+        os.environ['TRAVIS_REPO_SLUG'] = 'Azure/azure-sdk-for-python'
+        os.environ['TRAVIS_PULL_REQUEST'] = '568'
+        os.environ['TRAVIS_COMMIT'] = 'concurrentsha'
+        calls = []
+
+        def resolve(gh_token):
+            calls.append(gh_token)
+            time.sleep(0.2)
+            return 'pr'
+
+        find_initial_pr.cache_clear()
+        with mock.patch('SwaggerToSdk.get_pr_object_from_travis', side_effect=resolve):
+            threads = [threading.Thread(target=get_initial_pr, args=(GH_TOKEN,)) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(get_initial_pr(GH_TOKEN), 'pr')
+        find_initial_pr.cache_clear()
+        self.assertEqual(len(calls), 1)
+
+    def test_schedule_generations(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+
+        def generation(key, fail=False):
+            def run(process_callback):
+                with lock:
+                    state['running'] += 1
+                    state['max_running'] = max(state['max_running'], state['running'])
+                process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(0.6)'])
+                process_callback(process)
+                process.wait()
+                with lock:
+                    state['running'] -= 1
+                if fail:
+                    raise ValueError(key)
+                return key
+            return run
+
+        generations = [(key, 1024, generation(key)) for key in 'abc']
+        results = list(schedule_generations(generations, max_jobs=2, memory_reserve=0))
+        self.assertSetEqual({key for key, _, _ in results}, {'a', 'b', 'c'})
+        self.assertTrue(all(key == result for key, result, _ in results))
+        self.assertEqual(state['max_running'], 2)
+        if sys.platform.startswith('linux'):
+            self.assertTrue(all(peak_rss for _, _, peak_rss in results))
+
+        # Not enough memory for two generations at once
+        state['max_running'] = 0
+        generations = [(key, 1024 ** 3, generation(key)) for key in 'abc']
+        with mock.patch('SwaggerToSdk.get_available_memory', return_value=1.5 * 1024 ** 3):
+            results = list(schedule_generations(generations, max_jobs=3, memory_reserve=0))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(state['max_running'], 1)
+
+        # After a failure, pending generations are not started
+        generations = [('a', 0, generation('a', fail=True)), ('b', 0, generation('b'))]
+        with self.assertRaises(ValueError):
+            list(schedule_generations(generations, max_jobs=1))
+
+    def test_predict_autorest_memory(self):
+        self.assertDictEqual(predict_autorest_memory(['a', 'b'], {}),
+                             {'a': DEFAULT_AUTOREST_MEMORY, 'b': DEFAULT_AUTOREST_MEMORY})
+        self.assertDictEqual(predict_autorest_memory(['a', 'b', 'c'], {'a': 10, 'b': 20}),
+                             {'a': 10, 'b': 20, 'c': 20})
+
+    def test_history_peak_rss(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history_db = str(Path(temp_dir, 'history.db'))
+            with closing(sqlite3.connect(history_db)) as connection, connection:
+                # History before peak_rss
+                connection.execute(HISTORY_SCHEMA.replace(',\n    peak_rss INTEGER,\n    autorest_hash TEXT', ''))
+                connection.execute("INSERT INTO project_timing VALUES (0, 'old', 'latest', 'hash', 1., 1., 1, 0)")
+            timing = {
+                'autorest_version': 'latest',
+                'spec_hash': 'hash',
+                'generate_duration': 10.,
+                'update_duration': 1.,
+                'output_size': 1024,
+                'output_changed': True
+            }
+            record_project_timing(history_db, 1, 'project', dict(timing, peak_rss=100))
+            record_project_timing(history_db, 2, 'project', dict(timing, peak_rss=300))
+            record_project_timing(history_db, 3, 'project', timing)
+            self.assertDictEqual(load_history_peak_rss(history_db), {'project': 300})
+
+    def test_history_autorest_changed(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history_db = str(Path(temp_dir, 'history.db'))
+            timing = {
+                'autorest_version': 'latest',
+                'autorest_hash': 'binary1',
+                'spec_hash': 'hash',
+                'generate_duration': 10.,
+                'update_duration': 1.,
+                'output_size': 1024,
+                'output_changed': True
+            }
+            for run_started in range(3):
+                record_project_timing(history_db, run_started, 'project', timing)
+            # "latest" moved to a new binary
+            record_project_timing(history_db, 3, 'project', dict(timing, generate_duration=20., autorest_hash='binary2'))
+
+            regressions = find_regressions(history_db, 0.5)
+            self.assertEqual(len(regressions), 1)
+            self.assertTrue(regressions[0]['autorest_changed'])
+            self.assertFalse(regressions[0]['spec_changed'])
+
+    def test_artifact_store(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = {'url': str(Path(temp_dir, 'store')), 'max_size': 10 * 1024 * 1024}
+            generated = Path(temp_dir, 'generated')
+            Path(generated, 'inside').mkdir(parents=True)
+            Path(generated, 'inside', 'generated.py').write_bytes(b'x = 1\n')
+            Path(generated, 'inside', 'script.sh').write_bytes(b'#!/bin/sh\n')
+            Path(generated, 'inside', 'script.sh').chmod(0o755)
+
+            self.assertFalse(fetch_generated(store, 'key', str(Path(temp_dir, 'missing'))))
+
+            publish_generated(store, 'key', str(generated))
+            fetched = Path(temp_dir, 'fetched')
+            self.assertTrue(fetch_generated(store, 'key', str(fetched)))
+            self.assertEqual(Path(fetched, 'inside', 'generated.py').read_bytes(), b'x = 1\n')
+            if os.name != 'nt':
+                self.assertTrue(os.access(str(Path(fetched, 'inside', 'script.sh')), os.X_OK))
+
+            # Integrity check
+            Path(store['url'], 'key.zip').write_bytes(b'corrupted')
+            self.assertFalse(fetch_generated(store, 'key', str(Path(temp_dir, 'corrupted'))))
+            self.assertFalse(Path(temp_dir, 'corrupted').exists())
+
+    def test_directory_store_evict(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for index, name in enumerate(['old', 'used', 'new']):
+                directory_store_put(temp_dir, name + '.zip', b'x' * 100)
+                directory_store_put(temp_dir, name + '.zip.sha256', b'digest')
+                os.utime(str(Path(temp_dir, name + '.zip')), (index, index))
+            directory_store_get(temp_dir, 'used.zip')
+
+            directory_store_evict(temp_dir, 200)
+            self.assertSetEqual({path.name for path in Path(temp_dir).iterdir()},
+                                {'new.zip', 'new.zip.sha256', 'used.zip', 'used.zip.sha256'})
+
+    def test_directory_store_shared(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory_store_put(temp_dir, 'key.zip', b'content')
+            if os.name != 'nt':
+                self.assertEqual(Path(temp_dir, 'key.zip').stat().st_mode & 0o777, 0o666 & ~UMASK)
+
+            # Artifact of another user or read-only store, still a hit
+            with mock.patch('os.utime', side_effect=PermissionError(1, 'Operation not permitted')):
+                self.assertEqual(directory_store_get(temp_dir, 'key.zip'), b'content')
+
+    def test_directory_store_put_concurrent(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            contents = [bytes([index]) * 1024 * 1024 for index in range(4)]
+            threads = [threading.Thread(target=directory_store_put, args=(temp_dir, 'key.zip', content))
+                       for content in contents]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertIn(directory_store_get(temp_dir, 'key.zip'), contents)
+            self.assertListEqual([path.name for path in Path(temp_dir).iterdir()], ['key.zip'])
+
+    def test_get_artifact_store_backend(self):
+        self.assertEqual(get_artifact_store_backend('https://store.example.com/artifacts')[0], http_store_get)
+        self.assertEqual(get_artifact_store_backend('/mnt/artifacts')[0], directory_store_get)
+
+    def test_generate_project_from_artifact_store(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = {'url': str(Path(temp_dir, 'store')), 'max_size': 10 * 1024 * 1024}
+            generated = Path(temp_dir, 'generated')
+            generated.mkdir()
+            Path(generated, 'generated.py').write_bytes(b'x = 1\n')
+            publish_generated(store, 'key', str(generated))
+
+            timing = generate_project('Python', {'swagger': 'swagger.json', 'output_dir': 'output'},
+                                      temp_dir, temp_dir, 'AutoRest.exe', {},
+                                      artifact_store=store, artifact_key='key')
+            self.assertTrue(timing['cached'])
+            self.assertFalse(timing['resumed'])
+            self.assertEqual(Path(timing['generated_path'], 'generated.py').read_bytes(), b'x = 1\n')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file